@@ -7,6 +7,8 @@ from tensorflow.contrib.keras import preprocessing
 from tensorflow.contrib.keras import optimizers
 
 import os
+import queue
+import threading
 import numpy as np
 
 HEIGHT = 32
@@ -30,6 +32,35 @@ def save_image(filename, x):
     img.save(os.path.join(SAVE_DIR, filename))
 
 
+class RealBatchProducer(object):
+    """Gathers batches of the training images in a new random order for each pass on a background thread,
+    into a ring of preallocated buffers. A batch stays valid until the next one is requested.
+    """
+    def __init__(self, x_train, batch_size, num_buffers=3):
+        self.x_train = x_train
+        self.batch_size = batch_size
+        self.buffers = np.empty((num_buffers, batch_size) + x_train.shape[1:], dtype=x_train.dtype)
+        # one buffer is filled by the producer and one is used by the consumer, while the others are queued
+        self.queue = queue.Queue(maxsize=num_buffers - 2)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        random_state = np.random.RandomState()
+        k = 0
+        while True:
+            perm = random_state.permutation(len(self.x_train))
+            for start in range(0, len(perm) - self.batch_size + 1, self.batch_size):
+                buffer = self.buffers[k % len(self.buffers)]
+                np.take(self.x_train, perm[start:start + self.batch_size], axis=0, out=buffer)
+                self.queue.put(buffer)
+                k += 1
+
+    def next_batch(self):
+        return self.queue.get()
+
+
 class DCGAN(object):
     def __init__(self, args):
         self._generator = None
@@ -120,8 +151,8 @@ class DCGAN(object):
 
     def discriminate(self, generated_images, real_images):
         combined_images = np.concatenate([generated_images, real_images])
-        labels = np.concatenate([np.ones((args.batch_size, 1)),
-                                 np.zeros((args.batch_size, 1))])
+        labels = np.concatenate([np.ones((self.args.batch_size, 1)),
+                                 np.zeros((self.args.batch_size, 1))])
         # trick: add slight random noise to the labels
         labels += 0.05 * np.random.random(labels.shape)
         loss = self.discriminator.train_on_batch(combined_images, labels)
@@ -138,6 +169,36 @@ class DCGAN(object):
         loss = self.adversarial.train_on_batch(random_latent, misleading_targets)
         return loss
 
+    def allocate_buffers(self):
+        """Preallocates the combined images (generated first, then real) and the labels of the discriminator
+        batches, as well as the targets of the adversarial batches, for `train_step`.
+        """
+        batch_size = self.args.batch_size
+        self.combined_images = np.empty((2 * batch_size, HEIGHT, WIDTH, CHANNELS), dtype=np.float32)
+        self.base_labels = np.concatenate([np.ones((batch_size, 1)),
+                                           np.zeros((batch_size, 1))]).astype(np.float32)
+        self.labels = np.empty_like(self.base_labels)
+        self.misleading_targets = np.zeros((batch_size, 1), dtype=np.float32)
+
+    def draw_latents(self, num_steps):
+        """Draws the latent vectors (for D and G) and the label noise of `num_steps` steps at once.
+        """
+        latents = np.random.normal(size=(num_steps, 2, self.args.batch_size,
+                                         self.args.latent_dims)).astype(np.float32)
+        label_noise = 0.05 * np.random.random((num_steps,) + self.base_labels.shape).astype(np.float32)
+        return latents, label_noise
+
+    def train_step(self, d_latent, g_latent, real_images, label_noise):
+        """Same as `generate`, `discriminate` and `train_on_batch`, but using the preallocated buffers.
+        """
+        batch_size = self.args.batch_size
+        self.combined_images[:batch_size] = self.generator.predict_on_batch(d_latent)
+        self.combined_images[batch_size:] = real_images
+        np.add(self.base_labels, label_noise, out=self.labels)
+        d_loss = self.discriminator.train_on_batch(self.combined_images, self.labels)
+        adv_loss = self.adversarial.train_on_batch(g_latent, self.misleading_targets)
+        return d_loss, adv_loss
+
     def save(self, path):
         os.makedirs(path, exist_ok=True)
         self.adversarial.save_weights(os.path.join(path, 'gan.h5'))
@@ -159,12 +220,43 @@ class DCGAN(object):
         return self._adversarial
 
 
+def train_pipelined(dcgan, x_train, args):
+    """Trains with preallocated buffers, latent vectors drawn once per epoch, and the next real batch
+    being gathered on a background thread, while the models are trained.
+    """
+    dcgan.allocate_buffers()
+    producer = RealBatchProducer(x_train, args.batch_size)
+    steps_per_epoch = len(x_train) // args.batch_size
+
+    for step in range(args.steps):
+        k = step % steps_per_epoch
+        if k == 0:
+            latents, label_noise = dcgan.draw_latents(min(steps_per_epoch, args.steps - step))
+
+        real_images = producer.next_batch()
+        d_loss, adv_loss = dcgan.train_step(latents[k, 0], latents[k, 1], real_images, label_noise[k])
+
+        if step % 100 == 0:
+            dcgan.save(SAVE_DIR)
+
+            generated_images = dcgan.combined_images[:args.batch_size]
+            print(generated_images.min(), generated_images.mean(), generated_images.max())
+            print('D loss: {:.4f}   ADV loss: {}'.format(d_loss, adv_loss))
+
+            save_image('generated_{:05d}.png'.format(step), generated_images[0])
+            save_image('real_{:05d}.png'.format(step), real_images[0])
+
+
 def main(args):
     x_train = cifar10_frogs()
 
     dcgan = DCGAN(args)
     dcgan.build()
 
+    if args.pipelined:
+        train_pipelined(dcgan, x_train, args)
+        return
+
     start = 0
     for step in range(args.steps):
         generated_images = dcgan.generate()
@@ -208,5 +300,7 @@ if __name__ == '__main__':
                         help='The dimensions of the latent space')
     parser.add_argument('--dropout', type=float, default=0.25,
                         help='The dropout in the discriminator to use')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Train with preallocated buffers and a background thread producing the real batches')
     args = parser.parse_args()
     main(args)
@@ -5,21 +5,33 @@ import zipfile
 
 from glob import glob
 
+import numpy as np
 import tensorflow as tf
 
 import generative_adversarial_networks.tensorflow.models as models
+import generative_adversarial_networks.tensorflow.profiling as profiling
 import generative_adversarial_networks.tensorflow.utils as utils
 
 DATA_ROOT = '../../data/tmp/celeb'
 OUTPUT_ROOT = 'tmp/celeb'
 
 
-def get_celeb_filenames():
+def get_celeb_filenames(num_workers=None):
     if not os.path.exists(DATA_ROOT):
         os.mkdir(DATA_ROOT)
 
-    # eventual place where our final data will reside
-    if not os.path.exists(os.path.join(DATA_ROOT, 'img_align_celeba-cropped')):
+    # eventual place where our final data will reside, which is marked as complete once all images are cropped
+    cropped_dir = os.path.join(DATA_ROOT, 'img_align_celeba-cropped')
+    done_file = os.path.join(cropped_dir, '.done')
+
+    # checkouts from before the marker have a complete cropped dir, but possibly no raw data to crop it again
+    if not os.path.exists(done_file) and os.path.isdir(cropped_dir) and \
+            not os.path.exists(os.path.join(DATA_ROOT, 'img_align_celeba')) and \
+            len(glob(os.path.join(cropped_dir, '*.jpg'))) > 0:
+        print("Found cropped images without the raw data, marking them as complete.")
+        open(done_file, 'w').close()
+
+    if not os.path.exists(done_file):
 
         # check for original data
         if not os.path.exists(os.path.join(DATA_ROOT, 'img_align_celeba')):
@@ -41,26 +53,41 @@ def get_celeb_filenames():
         n = len(filenames)
         print("Found %d files!" % n)
 
-        # crop the images to 64x64
-        os.mkdir(os.path.join(DATA_ROOT, 'img_align_celeba-cropped'))
+        # crop the images to 64x64, continuing where an interrupted run stopped
         print("Cropping images, please wait...")
-
-        for i in range(n):
-            utils.crop_and_resave(filenames[i], os.path.join(DATA_ROOT, 'img_align_celeba-cropped'))
-            if i % 1000 == 0:
-                print("%d/%d" % (i, n))
+        utils.crop_and_resave_all(filenames, cropped_dir, num_workers=num_workers)
+        open(done_file, 'w').close()
 
     # make sure to return the cropped version
     filenames = glob(os.path.join(DATA_ROOT, "img_align_celeba-cropped/*.jpg"))
     return filenames
 
 
+def get_celeb_shard(num_workers=None):
+    shard_file = os.path.join(DATA_ROOT, 'img_align_celeba-cropped.npy')
+    manifest_file = os.path.join(DATA_ROOT, 'img_align_celeba-cropped.json')
+
+    # the manifest is only written once the shard is complete
+    if not os.path.exists(manifest_file):
+        filenames = get_celeb_filenames(num_workers)
+
+        # shuffle once, because the batches are read as contiguous slices of the shard
+        np.random.shuffle(filenames)
+        print("Packing images, please wait...")
+        utils.pack_images(filenames, shard_file, manifest_file)
+
+    return np.load(shard_file, mmap_mode='r')
+
+
 def main(_):
     # make dir to save samples
     if not os.path.exists(OUTPUT_ROOT):
         os.makedirs(OUTPUT_ROOT)
 
-    X = get_celeb_filenames()
+    if FLAGS.packed:
+        X = get_celeb_shard(FLAGS.crop_workers)
+    else:
+        X = get_celeb_filenames(FLAGS.crop_workers)
     dim = 64
     colors = 3
 
@@ -87,10 +114,25 @@ def main(_):
         'output_activation': tf.tanh,
     }
 
-    model = models.DCGAN(dim, colors, d_sizes, g_sizes, FLAGS.lr, FLAGS.beta1)
+    model = models.DCGAN(dim, colors, d_sizes, g_sizes, FLAGS.lr, FLAGS.beta1,
+                         fused_step=FLAGS.fused_step)
+    profiler = None
+    if FLAGS.profile_dir is not None:
+        profiler = profiling.StepProfiler(FLAGS.profile_dir, trace_steps=FLAGS.trace_steps,
+                                          summary_interval=FLAGS.profile_interval)
+
     model.fit(X, epochs=FLAGS.epochs, batch_size=FLAGS.batch_size,
               save_sample_interval=FLAGS.save_sample_interval,
-              output_root=OUTPUT_ROOT)
+              output_root=OUTPUT_ROOT,
+              profiler=profiler,
+              checkpoint_dir=FLAGS.checkpoint_dir,
+              checkpoint_interval=FLAGS.checkpoint_interval,
+              decode_workers=FLAGS.decode_workers,
+              prefetch=FLAGS.prefetch,
+              shuffle_window=FLAGS.shuffle_window)
+
+    if FLAGS.export_dir is not None:
+        model.export_generator(FLAGS.export_dir)
 
 
 if __name__ == '__main__':
@@ -105,5 +147,31 @@ if __name__ == '__main__':
                         help='The beta1 coefficient for the optimizer')
     parser.add_argument('--save_sample_interval', type=int, default=50,
                         help='The interval for saving sample images')
+    parser.add_argument('--fused_step', action='store_true',
+                        help='Run the discriminator and both generator updates in a single session run')
+    parser.add_argument('--crop_workers', type=int, default=None,
+                        help='The number of processes cropping the images (defaults to the number of cores)')
+    parser.add_argument('--packed', action='store_true',
+                        help='Train on a memory-mapped uint8 shard of the cropped images, instead of the JPEGs. '
+                             'The shard is shuffled once when packed, and each epoch only within --shuffle_window')
+    parser.add_argument('--shuffle_window', type=int, default=8,
+                        help='The number of packed batches, whose images are shuffled among each other each epoch '
+                             '(1 keeps the composition of the batches fixed)')
+    parser.add_argument('--decode_workers', type=int, default=4,
+                        help='The number of background threads decoding the images')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='The number of decoded batches to prefetch')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='If set, the time of the training phases is recorded and saved as Chrome trace there')
+    parser.add_argument('--profile_interval', type=int, default=100,
+                        help='The interval for printing the p50/p95 time of the training phases')
+    parser.add_argument('--trace_steps', type=int, nargs='*', default=[],
+                        help='The steps, whose session runs are traced with TF RunMetadata')
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='If set, checkpoints are written there and training resumes from the latest one')
+    parser.add_argument('--checkpoint_interval', type=int, default=500,
+                        help='The interval (in steps) for writing checkpoints')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='If set, the trained generator is exported there (see sample_dcgan.py)')
     FLAGS, unparsed = parser.parse_known_args()
     main([sys.argv[0]] + unparsed)
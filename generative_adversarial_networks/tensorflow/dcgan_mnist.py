@@ -7,6 +7,7 @@ import tensorflow as tf
 from tensorflow.examples.tutorials.mnist import input_data
 
 import generative_adversarial_networks.tensorflow.models as models
+import generative_adversarial_networks.tensorflow.profiling as profiling
 
 DATA_ROOT = '../../data/tmp/mnist'
 OUTPUT_ROOT = 'tmp/mnist'
@@ -44,10 +45,22 @@ def main(_):
         'output_activation': tf.sigmoid,
     }
 
-    model = models.DCGAN(dim, colors, d_sizes, g_sizes, FLAGS.lr, FLAGS.beta1)
+    model = models.DCGAN(dim, colors, d_sizes, g_sizes, FLAGS.lr, FLAGS.beta1,
+                         fused_step=FLAGS.fused_step)
+    profiler = None
+    if FLAGS.profile_dir is not None:
+        profiler = profiling.StepProfiler(FLAGS.profile_dir, trace_steps=FLAGS.trace_steps,
+                                          summary_interval=FLAGS.profile_interval)
+
     model.fit(X, epochs=FLAGS.epochs, batch_size=FLAGS.batch_size,
               save_sample_interval=FLAGS.save_sample_interval,
-              output_root=OUTPUT_ROOT)
+              output_root=OUTPUT_ROOT,
+              profiler=profiler,
+              checkpoint_dir=FLAGS.checkpoint_dir,
+              checkpoint_interval=FLAGS.checkpoint_interval)
+
+    if FLAGS.export_dir is not None:
+        model.export_generator(FLAGS.export_dir)
 
 
 if __name__ == '__main__':
@@ -62,5 +75,19 @@ if __name__ == '__main__':
                         help='The beta1 coefficient for the optimizer')
     parser.add_argument('--save_sample_interval', type=int, default=50,
                         help='The interval for saving sample images')
+    parser.add_argument('--fused_step', action='store_true',
+                        help='Run the discriminator and both generator updates in a single session run')
+    parser.add_argument('--profile_dir', type=str, default=None,
+                        help='If set, the time of the training phases is recorded and saved as Chrome trace there')
+    parser.add_argument('--profile_interval', type=int, default=100,
+                        help='The interval for printing the p50/p95 time of the training phases')
+    parser.add_argument('--trace_steps', type=int, nargs='*', default=[],
+                        help='The steps, whose session runs are traced with TF RunMetadata')
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='If set, checkpoints are written there and training resumes from the latest one')
+    parser.add_argument('--checkpoint_interval', type=int, default=500,
+                        help='The interval (in steps) for writing checkpoints')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='If set, the trained generator is exported there (see sample_dcgan.py)')
     FLAGS, unparsed = parser.parse_known_args()
     main([sys.argv[0]] + unparsed)
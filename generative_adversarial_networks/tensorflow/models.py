@@ -1,4 +1,6 @@
 from datetime import datetime
+import itertools
+import json
 import os
 
 import matplotlib.pyplot as plt
@@ -6,7 +8,26 @@ import numpy as np
 import scipy as sp
 import tensorflow as tf
 
+import generative_adversarial_networks.tensorflow.profiling as profiling
 import generative_adversarial_networks.tensorflow.utils as utils
+from utils.batches import BatchIterator
+
+
+def read_layer_params(layer, read_params):
+    """Returns the weights and bias of the layer. With `read_params`, they are read by new ops, which are
+    created in the current control dependency context, instead of the reads created with the variables.
+    """
+    if read_params:
+        return layer.W.read_value(), layer.b.read_value()
+    return layer.W, layer.b
+
+
+def read_trainable_getter(getter, *args, **kwargs):
+    """Custom getter, which reads the trainable variables (e.g. of batch norm) in the current control dependency
+    context. The non-trainable variables (e.g. the moving averages) are returned as is, so they can be assigned.
+    """
+    variable = getter(*args, **kwargs)
+    return variable.read_value() if kwargs.get('trainable', True) else variable
 
 
 class ConvLayer(object):
@@ -28,14 +49,15 @@ class ConvLayer(object):
         self.apply_batch_norm = apply_batch_norm
         self.params = [self.W, self.b]
 
-    def forward(self, X, reuse, is_training):
+    def forward(self, X, reuse, is_training, read_params=False):
+        W, b = read_layer_params(self, read_params)
         conv_out = tf.nn.conv2d(
             X,
-            self.W,
+            W,
             strides=[1, self.stride, self.stride, 1],
             padding='SAME'
         )
-        conv_out = tf.nn.bias_add(conv_out, self.b)
+        conv_out = tf.nn.bias_add(conv_out, b)
 
         # apply batch normalization
         if self.apply_batch_norm:
@@ -72,14 +94,15 @@ class FractionallyStridedConvLayer(object):
         self.apply_batch_norm = apply_batch_norm
         self.params = [self.W, self.b]
 
-    def forward(self, X, reuse, is_training):
+    def forward(self, X, reuse, is_training, read_params=False):
+        W, b = read_layer_params(self, read_params)
         conv_out = tf.nn.conv2d_transpose(
             value=X,
-            filter=self.W,
+            filter=W,
             output_shape=self.output_shape,
             strides=[1, self.stride, self.stride, 1],
         )
-        conv_out = tf.nn.bias_add(conv_out, self.b)
+        conv_out = tf.nn.bias_add(conv_out, b)
 
         # apply batch normalization
         if self.apply_batch_norm:
@@ -114,8 +137,9 @@ class DenseLayer(object):
         self.apply_batch_norm = apply_batch_norm
         self.params = [self.W, self.b]
 
-    def forward(self, X, reuse, is_training):
-        a = tf.matmul(X, self.W) + self.b
+    def forward(self, X, reuse, is_training, read_params=False):
+        W, b = read_layer_params(self, read_params)
+        a = tf.matmul(X, W) + b
 
         # apply batch normalization
         if self.apply_batch_norm:
@@ -133,7 +157,7 @@ class DenseLayer(object):
 
 
 class DCGAN(object):
-    def __init__(self, img_size, img_channels, d_sizes, g_sizes, opt_lr, opt_beta1):
+    def __init__(self, img_size, img_channels, d_sizes, g_sizes, opt_lr, opt_beta1, fused_step=False):
         self.img_size = img_size
         self.img_channels = img_channels
         self.latent_dims = g_sizes['z']
@@ -169,15 +193,50 @@ class DCGAN(object):
         self.d_params = [t for t in tf.trainable_variables() if t.name.startswith('d')]
         self.g_params = [t for t in tf.trainable_variables() if t.name.startswith('g')]
 
-        self.d_train_op = tf.train.AdamOptimizer(opt_lr, beta1=opt_beta1) \
-            .minimize(self.d_cost, var_list=self.d_params)
-        self.g_train_op = tf.train.AdamOptimizer(opt_lr, beta1=opt_beta1) \
-            .minimize(self.g_cost, var_list=self.g_params)
+        d_optimizer = tf.train.AdamOptimizer(opt_lr, beta1=opt_beta1)
+        g_optimizer = tf.train.AdamOptimizer(opt_lr, beta1=opt_beta1)
+        self.d_train_op = d_optimizer.minimize(self.d_cost, var_list=self.d_params)
+        self.g_train_op = g_optimizer.minimize(self.g_cost, var_list=self.g_params)
+
+        self.fused_train_op = None
+        if fused_step:
+            self.build_fused_train_op(g_optimizer)
 
         self.init_op = tf.global_variables_initializer()
         self.sess = tf.InteractiveSession()
         self.sess.run(self.init_op)
 
+    def build_fused_train_op(self, g_optimizer):
+        """Builds a single op, which runs the discriminator update followed by two generator updates,
+        so that a training step needs only one session run. The second generator update recomputes the
+        generator cost with the weights of the first one, like two separate runs of g_train_op would.
+        The optimizer (and thus its slots) is shared with g_train_op.
+
+        The parameters are read again inside of each control dependency block, so that the order does not
+        rely on the aliasing of ref variables: the reads created with the variables may run before the updates.
+        """
+        with tf.control_dependencies([self.d_train_op]):
+            g_cost1 = self._generator_cost()
+            g_train_op1 = g_optimizer.minimize(g_cost1, var_list=self.g_params)
+        with tf.control_dependencies([g_train_op1]):
+            g_cost2 = self._generator_cost()
+            g_train_op2 = g_optimizer.minimize(g_cost2, var_list=self.g_params)
+
+        self.fused_train_op = g_train_op2
+        self.fused_g_cost = (g_cost1 + g_cost2) / 2
+
+    def _generator_cost(self):
+        """Builds the generator cost on reads of the parameters, which are gated by the enclosing control dependencies.
+        """
+        with tf.variable_scope('generator', custom_getter=read_trainable_getter) as scope:
+            scope.reuse_variables()
+            sample_images = self.generator_forward(self.Z, reuse=True, read_params=True)
+        with tf.variable_scope('discriminator', custom_getter=read_trainable_getter) as scope:
+            scope.reuse_variables()
+            sample_logits = self.discriminator_forward(sample_images, reuse=True, read_params=True)
+        return tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(logits=sample_logits, labels=tf.ones_like(sample_logits)))
+
     def build_generator(self, Z, g_sizes):
         with tf.variable_scope('generator'):
             dims = [self.img_size]
@@ -234,10 +293,10 @@ class DCGAN(object):
             self.g_sizes = g_sizes
             return self.generator_forward(Z)
 
-    def generator_forward(self, Z, reuse=None, is_training=True):
+    def generator_forward(self, Z, reuse=None, is_training=True, read_params=False):
         output = Z
         for layer in self.g_dense_layers:
-            output = layer.forward(output, reuse, is_training)
+            output = layer.forward(output, reuse, is_training, read_params)
 
         output = tf.reshape(output, [-1, self.g_dims[0], self.g_dims[0], self.g_sizes['projection']])
 
@@ -254,7 +313,7 @@ class DCGAN(object):
             )
 
         for layer in self.g_conv_layers:
-            output = layer.forward(output, reuse, is_training)
+            output = layer.forward(output, reuse, is_training, read_params)
 
         return output
 
@@ -292,59 +351,128 @@ class DCGAN(object):
             logits = self.discriminator_forward(X)
             return logits
 
-    def discriminator_forward(self, X, reuse=None, is_training=True):
+    def discriminator_forward(self, X, reuse=None, is_training=True, read_params=False):
         output = X
         for layer in self.d_conv_layers:
-            output = layer.forward(output, reuse, is_training)
+            output = layer.forward(output, reuse, is_training, read_params)
         output = tf.contrib.layers.flatten(output)
         for layer in self.d_dense_layers:
-            output = layer.forward(output, reuse, is_training)
-        logits = self.d_final_layer.forward(output, reuse, is_training)
+            output = layer.forward(output, reuse, is_training, read_params)
+        logits = self.d_final_layer.forward(output, reuse, is_training, read_params)
         return logits
 
-    def fit(self, X, epochs, batch_size, save_sample_interval=100, output_root='tmp'):
+    def fit(self, X, epochs, batch_size, save_sample_interval=100, output_root='tmp',
+            decode_workers=4, prefetch=4, profiler=None, checkpoint_dir=None, checkpoint_interval=500,
+            shuffle_window=8):
+        """Trains the GAN. If a `checkpoint_dir` is given, a checkpoint is written every `checkpoint_interval`
+        steps and training resumes from the latest checkpoint in there. Since the order of the batches is
+        redrawn, a resumed epoch trains on the remaining number of batches, but not on the remaining images.
+        Packed images are only shuffled within windows of `shuffle_window` batches (see `shuffled_shard_batches`).
+        """
+        if profiler is None:
+            # records the phases anyway, but neither prints nor saves them
+            profiler = profiling.StepProfiler(summary_interval=0)
+
+        # the sample images are written in the background, so that saving them does not stall training
+        writer = utils.ImageWriter()
+
         d_costs = []
         g_costs = []
 
         n = len(X)
         n_batches = n // batch_size
+        packed = isinstance(X, np.ndarray) and X.dtype == np.uint8
+        filenames = type(X[0]) is str
+        if not packed:
+            # the filenames are kept around by the prefetching, so they need fresh arrays for each batch
+            shuffled_batches = BatchIterator(X, batch_size, reuse_buffers=not filenames)
         step = 0
-        for i in range(epochs):
-            print('Starting epoche: {}'.format(i))
-            np.random.shuffle(X)
-            for j in range(n_batches):
-                t0 = datetime.now()
-
-                batch = X[j * batch_size:(j + 1) * batch_size]
-                if type(X[0]) is str:
-                    # celeb
-                    batch = utils.files2images(batch)
-
-                Z = np.random.uniform(-1, 1, size=(batch_size, self.latent_dims))
-
-                # discriminator training
-                _, d_cost, d_acc = self.sess.run([self.d_train_op, self.d_cost, self.d_accuracy], {
-                    self.X: batch, self.Z: Z
-                })
-                d_costs.append(d_cost)
-
-                # generator training
-                _, g_cost1 = self.sess.run([self.g_train_op, self.g_cost], {
-                    self.Z: Z
-                })
-                _, g_cost2 = self.sess.run([self.g_train_op, self.g_cost], {
-                    self.Z: Z
-                })
-                g_costs.append((g_cost1 + g_cost2) / 2)
-
-                print('Batch {}/{}: dt: {}, d_acc: {:.2f}'.format(j + 1, n_batches, datetime.now() - t0, d_acc))
-
-                step += 1
-                if step % save_sample_interval == 0:
-                    print('Saving a sample...')
-                    n_samples = 64
-                    samples = self.sample(n_samples)
-                    self._save_samples_image(os.path.join(output_root, 'samples_{:05d}.png'.format(step)), samples)
+
+        start_epoch = 0
+        skip_batches = 0
+        checkpointer = None
+        if checkpoint_dir is not None:
+            checkpointer = utils.CheckpointWriter(checkpoint_dir)
+            checkpoint_file = utils.latest_checkpoint(checkpoint_dir)
+            if checkpoint_file is not None:
+                step, start_epoch, skip_batches, d_costs, g_costs = self._restore_checkpoint(checkpoint_file)
+                if skip_batches >= n_batches:
+                    start_epoch += 1
+                    skip_batches = 0
+                print('Resuming from {} (step: {}, epoch: {})'.format(checkpoint_file, step, start_epoch))
+
+        try:
+            for i in range(start_epoch, epochs):
+                print('Starting epoche: {}'.format(i))
+                if packed:
+                    # packed images (e.g. a memory-mapped shard): contiguous blocks are visited in random order,
+                    # shuffled within windows of blocks and scaled to (-1, +1) in the background
+                    batches = utils.shuffled_shard_batches(X, batch_size, window=shuffle_window)
+                    batches = utils.prefetch_batches(batches, utils.bytes2batch,
+                                                     num_workers=decode_workers, prefetch=prefetch)
+                else:
+                    batches = iter(shuffled_batches)
+                    if filenames:
+                        # celeb: the images of the next batches are decoded in the background, while training
+                        batches = utils.prefetch_batches(batches, utils.files2batch,
+                                                         num_workers=decode_workers, prefetch=prefetch)
+
+                if skip_batches > 0:
+                    batches = itertools.islice(batches, n_batches - skip_batches)
+
+                for j, batch in enumerate(profiler.iterate('data', batches), skip_batches):
+                    t0 = datetime.now()
+
+                    Z = np.random.uniform(-1, 1, size=(batch_size, self.latent_dims))
+
+                    if self.fused_train_op is not None:
+                        # discriminator and generator training in a single run
+                        _, d_cost, d_acc, g_cost = profiler.run(
+                            self.sess, 'step', [self.fused_train_op, self.d_cost, self.d_accuracy, self.fused_g_cost], {
+                                self.X: batch, self.Z: Z
+                            })
+                        d_costs.append(d_cost)
+                        g_costs.append(g_cost)
+                    else:
+                        # discriminator training
+                        _, d_cost, d_acc = profiler.run(
+                            self.sess, 'd_step', [self.d_train_op, self.d_cost, self.d_accuracy], {
+                                self.X: batch, self.Z: Z
+                            })
+                        d_costs.append(d_cost)
+
+                        # generator training
+                        _, g_cost1 = profiler.run(self.sess, 'g_step1', [self.g_train_op, self.g_cost], {
+                            self.Z: Z
+                        })
+                        _, g_cost2 = profiler.run(self.sess, 'g_step2', [self.g_train_op, self.g_cost], {
+                            self.Z: Z
+                        })
+                        g_costs.append((g_cost1 + g_cost2) / 2)
+
+                    print('Batch {}/{}: dt: {}, d_acc: {:.2f}'.format(j + 1, n_batches, datetime.now() - t0, d_acc))
+
+                    step += 1
+                    if step % save_sample_interval == 0:
+                        print('Saving a sample...')
+                        with profiler.phase('sampling'):
+                            n_samples = 64
+                            samples = self.sample(n_samples)
+                            self._save_samples_image(os.path.join(output_root, 'samples_{:05d}.png'.format(step)),
+                                                     samples, writer)
+                    if checkpointer is not None and step % checkpoint_interval == 0:
+                        with profiler.phase('checkpoint'):
+                            checkpointer.save(step, self._checkpoint_arrays(step, i, j + 1, d_costs, g_costs))
+                    profiler.end_step()
+                skip_batches = 0
+
+            if checkpointer is not None:
+                checkpointer.save(step, self._checkpoint_arrays(step, epochs, 0, d_costs, g_costs))
+                checkpointer.close()
+            writer.close()
+        finally:
+            # the recorded phases are kept, even if training crashes or is interrupted
+            profiler.save()
 
         plt.clf()
         plt.plot(d_costs, label='Discriminator Cost')
@@ -352,33 +480,68 @@ class DCGAN(object):
         plt.legend()
         plt.savefig(os.path.join(output_root, 'training_costs.png'))
 
-    def _save_samples_image(self, filepath, samples):
-        n_samples = samples.shape[0]
-        n_samples_sqrt = int(np.sqrt(n_samples))
-        d = samples.shape[1]
-        if samples.shape[-1] == 1:
-            # gray image: (N x N)
-            samples = samples.reshape(n_samples, d, d)
-            flat_image = np.empty([n_samples_sqrt * d, n_samples_sqrt * d])
-
-            k = 0
-            for i in range(n_samples_sqrt):
-                for j in range(n_samples_sqrt):
-                    flat_image[i * d:(i + 1) * d, j * d:(j + 1) * d] = samples[k].reshape(d, d)
-                    k += 1
-        elif samples.shape[-1] == 3:
-            # color image: (N x N x 3)
-            flat_image = np.empty([n_samples_sqrt * d, n_samples_sqrt * d, 3])
-
-            k = 0
-            for i in range(n_samples_sqrt):
-                for j in range(n_samples_sqrt):
-                    flat_image[i * d:(i + 1) * d, j * d:(j + 1) * d] = samples[k]
-                    k += 1
+    def _checkpoint_arrays(self, step, epoch, batch, d_costs, g_costs):
+        """Takes a snapshot of all variables (G/D weights, batch norm statistics and optimizer slots) with a
+        single run, as well as of the training position and the numpy RNG state, which can be written
+        in the background while the training continues.
+        """
+        variables = tf.global_variables()
+        values = self.sess.run(variables)
+        arrays = {'variable/' + v.op.name: value for v, value in zip(variables, values)}
+
+        _, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        arrays.update({
+            'step': step,
+            'epoch': epoch,
+            'batch': batch,
+            'd_costs': np.asarray(d_costs),
+            'g_costs': np.asarray(g_costs),
+            'rng_keys': rng_keys,
+            'rng_pos': rng_pos,
+            'rng_has_gauss': rng_has_gauss,
+            'rng_cached_gaussian': rng_cached_gaussian,
+        })
+        return arrays
+
+    def _restore_checkpoint(self, checkpoint_file):
+        checkpoint = np.load(checkpoint_file)
+        for v in tf.global_variables():
+            v.load(checkpoint['variable/' + v.op.name], self.sess)
+
+        np.random.set_state(('MT19937', checkpoint['rng_keys'], int(checkpoint['rng_pos']),
+                             int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+        return (int(checkpoint['step']), int(checkpoint['epoch']), int(checkpoint['batch']),
+                list(checkpoint['d_costs']), list(checkpoint['g_costs']))
+
+    def _save_samples_image(self, filepath, samples, writer=None):
+        flat_image = utils.tile_images(samples)
+        if writer is None:
+            sp.misc.imsave(filepath, flat_image)
         else:
-            raise Exception('Invalid image shape!')
-
-        sp.misc.imsave(filepath, flat_image)
+            writer.write(filepath, flat_image)
+
+    def export_generator(self, export_dir):
+        """Exports the generator (in inference mode) as a frozen graph, which only contains the generator
+        and can be loaded by sampling.GeneratorSampler without rebuilding the discriminator or the optimizers.
+        """
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+        images = tf.identity(self.samples_images_test, name='generated_images')
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.sess, self.sess.graph.as_graph_def(), [images.op.name])
+        with tf.gfile.GFile(os.path.join(export_dir, 'generator.pb'), 'wb') as f:
+            f.write(graph_def.SerializeToString())
+
+        # range of the output activation, to convert the images to uint8
+        output_range = [-1.0, 1.0] if self.g_sizes['output_activation'] is tf.tanh else [0.0, 1.0]
+        with open(os.path.join(export_dir, 'generator.json'), 'w') as f:
+            json.dump({
+                'input': self.Z.name,
+                'output': images.name,
+                'latent_dims': self.latent_dims,
+                'image_shape': [self.img_size, self.img_size, self.img_channels],
+                'output_range': output_range,
+            }, f, indent=2)
 
     def sample(self, n):
         Z = np.random.uniform(-1, 1, size=[n, self.latent_dims])
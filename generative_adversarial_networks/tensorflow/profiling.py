@@ -0,0 +1,103 @@
+import contextlib
+import json
+import os
+import time
+
+from collections import defaultdict, deque
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class StepProfiler(object):
+    """
+    Records the wall time of the phases of each training step (e.g. data, d_step, g_step, sampling).
+
+    Every `summary_interval` steps, the p50/p95 of each phase over the last `window` steps is printed and
+    written to `phases_summary.json` in the `output_dir`.
+    `save` writes all recorded phases as a Chrome trace (open it with chrome://tracing), as well as a
+    TF timeline of the session runs of the steps in `trace_steps`, which were run with full tracing.
+    """
+    def __init__(self, output_dir=None, trace_steps=(), summary_interval=100, window=100, max_events=100000):
+        self.output_dir = output_dir
+        self.trace_steps = set(trace_steps)
+        self.summary_interval = summary_interval
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.events = deque(maxlen=max_events)
+        self.run_metadata = []
+        self.step = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        yield
+        end = time.time()
+        self.durations[name].append(end - start)
+        # complete event of the chrome trace format, the timestamps are in microseconds
+        self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                            'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': {'step': self.step}})
+
+    def iterate(self, name, iterable):
+        """Yields the items of the iterable, and records the time spent waiting for each of them.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def run(self, sess, name, fetches, feed_dict):
+        """Runs the fetches as phase `name`. The run is fully traced, if the current step is in `trace_steps`.
+        """
+        with self.phase(name):
+            if self.step not in self.trace_steps:
+                return sess.run(fetches, feed_dict)
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+            result = sess.run(fetches, feed_dict, options=run_options, run_metadata=run_metadata)
+        self.run_metadata.append((self.step, name, run_metadata))
+        return result
+
+    def end_step(self):
+        self.step += 1
+        if self.summary_interval and self.step % self.summary_interval == 0:
+            self.print_summary()
+            self.save_summary()
+
+    def summary(self):
+        """Returns the p50 and p95 of the durations (in seconds) of each phase, over the last steps.
+        """
+        return {name: (np.percentile(durations, 50), np.percentile(durations, 95))
+                for name, durations in self.durations.items() if len(durations) > 0}
+
+    def print_summary(self):
+        print('Step {}:'.format(self.step))
+        for name, (p50, p95) in sorted(self.summary().items()):
+            print('  {:<10} p50: {:8.2f}ms, p95: {:8.2f}ms'.format(name, p50 * 1000, p95 * 1000))
+
+    def save_summary(self):
+        if self.output_dir is None:
+            return
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        with open(os.path.join(self.output_dir, 'phases_summary.json'), 'w') as f:
+            json.dump({'step': self.step, 'phases': {name: {'p50': p50, 'p95': p95}
+                                                     for name, (p50, p95) in self.summary().items()}}, f, indent=2)
+
+    def save(self):
+        if self.output_dir is None:
+            return
+        self.save_summary()
+
+        with open(os.path.join(self.output_dir, 'phases_trace.json'), 'w') as f:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+        for step, name, run_metadata in self.run_metadata:
+            trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.output_dir, 'timeline_{:05d}_{}.json'.format(step, name)), 'w') as f:
+                f.write(trace)
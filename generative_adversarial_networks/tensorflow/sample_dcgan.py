@@ -0,0 +1,23 @@
+import argparse
+import sys
+
+import generative_adversarial_networks.tensorflow.sampling as sampling
+
+
+def main(_):
+    sampler = sampling.GeneratorSampler(FLAGS.export_dir)
+    sampler.sample_to_disk(FLAGS.num_samples, FLAGS.output_file, chunk_size=FLAGS.chunk_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export_dir', type=str, required=True,
+                        help='The directory of the exported generator')
+    parser.add_argument('--output_file', type=str, default='samples.npy',
+                        help='The .npy file, to which the uint8 images are written')
+    parser.add_argument('--num_samples', type=int, default=10000,
+                        help='The number of images to generate')
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='The number of images, which are generated at once')
+    FLAGS, unparsed = parser.parse_known_args()
+    main([sys.argv[0]] + unparsed)
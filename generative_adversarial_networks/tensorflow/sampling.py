@@ -0,0 +1,74 @@
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+
+class GeneratorSampler(object):
+    """
+    Generates images with a generator, which was exported by `DCGAN.export_generator`.
+
+    Only the frozen generator graph is loaded. Large sample counts are generated in chunks of fixed size
+    and streamed to a uint8 .npy file (the same layout as the packed celeb shard), so that the memory usage
+    stays bounded: while a chunk is generated, the previous one is written to disk in the background.
+    """
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, 'generator.json')) as f:
+            self.meta = json.load(f)
+        self.latent_dims = self.meta['latent_dims']
+        self.image_shape = tuple(self.meta['image_shape'])
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, 'generator.pb'), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.Z = self.graph.get_tensor_by_name(self.meta['input'])
+        self.images = self.graph.get_tensor_by_name(self.meta['output'])
+        self.sess = tf.Session(graph=self.graph)
+
+    def sample(self, n):
+        Z = np.random.uniform(-1, 1, size=[n, self.latent_dims])
+        return self.sess.run(self.images, {
+            self.Z: Z
+        })
+
+    def to_uint8(self, images):
+        low, high = self.meta['output_range']
+        return np.clip(np.round((images - low) / (high - low) * 255), 0, 255).astype(np.uint8)
+
+    def sample_to_disk(self, n, output_file, chunk_size=1024, print_interval=100):
+        """Generates n images in chunks and writes them as uint8 array of shape (N x H x W x C) to a .npy file.
+        Returns the throughput in images per second.
+        """
+        output = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.uint8, shape=(n,) + self.image_shape)
+
+        def write(start, images):
+            output[start:start + len(images)] = images
+
+        t0 = time.time()
+        n_chunks = int(np.ceil(n / float(chunk_size)))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+            for i, start in enumerate(range(0, n, chunk_size)):
+                images = self.to_uint8(self.sample(min(chunk_size, n - start)))
+                # at most one chunk is written, while the next one is generated
+                if pending is not None:
+                    pending.result()
+                pending = executor.submit(write, start, images)
+                if (i + 1) % print_interval == 0:
+                    images_per_second = (start + len(images)) / (time.time() - t0)
+                    print('Chunk {}/{}: {:.1f} images/s'.format(i + 1, n_chunks, images_per_second))
+            if pending is not None:
+                pending.result()
+        output.flush()
+        del output
+
+        images_per_second = n / max(time.time() - t0, 1e-6)
+        print('Generated {} images in {:.1f}s ({:.1f} images/s)'.format(n, time.time() - t0, images_per_second))
+        return images_per_second
@@ -1,5 +1,16 @@
+import functools
+import json
+import multiprocessing
+import os
+import queue
 import requests
+import threading
+import time
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 from scipy.misc import imread, imsave, imresize
 from tqdm import tqdm
 
@@ -19,14 +30,208 @@ def crop_and_resave(input_file, output_dir):
     cropped = image[edge_h:(edge_h + 108), edge_w:(edge_w + 108)]
     small = imresize(cropped, (64, 64))
 
+    # write to a hidden temporary file first, so that an interruption never leaves a partial image behind
     filename = input_file.split('/')[-1]
-    imsave("%s/%s" % (output_dir, filename), small)
+    temp_file = "%s/.%s" % (output_dir, filename)
+    imsave(temp_file, small)
+    os.rename(temp_file, "%s/%s" % (output_dir, filename))
+
+
+def crop_and_resave_all(input_files, output_dir, num_workers=None, chunksize=64):
+    """Crops and resizes the images using a pool of processes (one per core by default).
+    Images which already exist in the output directory are skipped, so this can be re-run after a crash.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    existing = set(os.listdir(output_dir))
+    remaining = [fn for fn in input_files if fn.split('/')[-1] not in existing]
+    n = len(remaining)
+    print("%d/%d images left to crop" % (n, len(input_files)))
+
+    t0 = time.time()
+    crop_fn = functools.partial(crop_and_resave, output_dir=output_dir)
+    with multiprocessing.Pool(num_workers) as pool:
+        for i, _ in enumerate(pool.imap_unordered(crop_fn, remaining, chunksize=chunksize)):
+            if (i + 1) % 1000 == 0:
+                print("%d/%d (%.1f images/s)" % (i + 1, n, (i + 1) / (time.time() - t0)))
+    print("Cropped %d images in %.1fs (%.1f images/s)" % (n, time.time() - t0, n / max(time.time() - t0, 1e-6)))
 
 
 def files2images(filenames):
     return [scale_image(imread(fn)) for fn in filenames]
 
 
+def files2batch(filenames):
+    return np.asarray(files2images(filenames), dtype=np.float32)
+
+
+def bytes2batch(images):
+    return scale_image(images.astype(np.float32))
+
+
+def pack_images(filenames, shard_file, manifest_file, image_shape=(64, 64, 3)):
+    """Packs the image files into a single uint8 .npy shard of shape (N x H x W x C), which can be
+    memory-mapped, and writes a JSON manifest of the packed files once the shard is complete.
+    """
+    shard = np.lib.format.open_memmap(shard_file, mode='w+', dtype=np.uint8,
+                                      shape=(len(filenames),) + tuple(image_shape))
+    for i, fn in enumerate(tqdm(filenames)):
+        shard[i] = imread(fn)
+    shard.flush()
+    del shard
+
+    with open(manifest_file, 'w') as f:
+        json.dump({
+            'shard': os.path.basename(shard_file),
+            'shape': [len(filenames)] + list(image_shape),
+            'dtype': 'uint8',
+            'files': [os.path.basename(fn) for fn in filenames],
+        }, f)
+
+
+def prefetch_batches(batches, load_fn, num_workers=4, prefetch=4, use_processes=False):
+    """Yields load_fn(batch) for each batch in order, while up to `prefetch` following batches
+    are already loaded by a pool of background workers.
+    """
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_cls(max_workers=num_workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(load_fn, batch))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def shuffled_shard_batches(X, batch_size, window=8, prefetch=1):
+    """Yields the uint8 batches of a packed shard in a new order each epoch, dropping the last incomplete batch.
+
+    The shard is read in blocks of `batch_size` contiguous images, which are visited in random order. The images
+    of `window` consecutive blocks are shuffled among each other, so that the composition of the batches changes
+    every epoch, while the reads remain contiguous slices. The windows are read in the background.
+    """
+    n_batches = len(X) // batch_size
+    order = np.random.permutation(n_batches)
+    windows = ([X[k * batch_size:(k + 1) * batch_size] for k in order[i:i + window]]
+               for i in range(0, n_batches, window))
+    for batches in prefetch_batches(windows, _shuffle_window, num_workers=1, prefetch=prefetch):
+        for batch in batches:
+            yield batch
+
+
+def _shuffle_window(blocks):
+    images = np.concatenate(blocks)
+    return np.split(images[np.random.permutation(len(images))], len(blocks))
+
+
+def tile_images(images, n_cols=None):
+    """Tiles N images of shape (H x W x C) into a single mosaic of shape (rows * H x cols * W x C),
+    or (rows * H x cols * W) for gray images. By default, the grid is as square as possible; missing
+    tiles of the last row are filled with the minimum value of the images.
+    """
+    n, h, w, c = images.shape
+    if c not in (1, 3):
+        raise Exception('Invalid image shape!')
+    if n_cols is None:
+        n_cols = int(np.ceil(np.sqrt(n)))
+    n_rows = int(np.ceil(n / float(n_cols)))
+
+    grid = np.full((n_rows * n_cols, h, w, c), np.min(images), dtype=images.dtype)
+    grid[:n] = images
+    # (rows, cols, H, W, C) -> (rows, H, cols, W, C)
+    mosaic = grid.reshape(n_rows, n_cols, h, w, c).transpose(0, 2, 1, 3, 4).reshape(n_rows * h, n_cols * w, c)
+    return mosaic[:, :, 0] if c == 1 else mosaic
+
+
+class ImageWriter(object):
+    """Encodes and writes images on a background thread. At most `max_pending` images are queued,
+    after that `write` blocks, so that a slow disk cannot use up the memory.
+    """
+    def __init__(self, max_pending=8):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filepath, image = item
+            try:
+                imsave(filepath, image)
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, filepath, image):
+        self._check_error()
+        self.queue.put((filepath, image))
+
+    def close(self):
+        """Waits until all queued images are written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._check_error()
+
+
+def list_checkpoints(checkpoint_dir):
+    """Returns the complete checkpoint files in the directory, from the oldest to the latest.
+    """
+    if not os.path.exists(checkpoint_dir):
+        return []
+    filenames = [fn for fn in os.listdir(checkpoint_dir) if fn.startswith('ckpt-') and fn.endswith('.npz')]
+    return [os.path.join(checkpoint_dir, fn) for fn in sorted(filenames)]
+
+
+def latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints (dicts of arrays) as .npz files on a background thread, and keeps the
+    latest `max_to_keep` of them. At most one checkpoint is written at a time.
+    """
+    def __init__(self, checkpoint_dir, max_to_keep=3):
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.checkpoint_dir = checkpoint_dir
+        self.max_to_keep = max_to_keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _write(self, step, arrays):
+        # write to a hidden temporary file first, so that a crash never leaves a partial checkpoint behind
+        filename = 'ckpt-{:08d}.npz'.format(step)
+        temp_file = os.path.join(self.checkpoint_dir, '.' + filename)
+        np.savez(temp_file, **arrays)
+        os.rename(temp_file, os.path.join(self.checkpoint_dir, filename))
+        for checkpoint_file in list_checkpoints(self.checkpoint_dir)[:-self.max_to_keep]:
+            os.remove(checkpoint_file)
+
+    def save(self, step, arrays):
+        self.wait()
+        self.pending = self.executor.submit(self._write, step, arrays)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
 def download_file_from_google_drive(file_id, dest):
     drive_url = "https://docs.google.com/uc?export=download"
 
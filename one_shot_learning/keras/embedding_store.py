@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+
+import one_shot_learning.keras.utils as utils
+
+
+def quantize(embeddings, dtype):
+    """Quantizes embeddings to int8 with one scale per vector, or to float16 (without scales).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == 'int8':
+        scales = np.max(np.abs(embeddings), axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.round(embeddings / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    elif dtype == 'float16':
+        return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+    else:
+        raise Exception('Unknown embedding store type.')
+
+
+class EmbeddingStore(object):
+    """
+    Compact store of embeddings, e.g. the 128-d outputs of the base network for a support set.
+
+    The embeddings are stored as int8 codes with one float32 scale per vector (4x smaller than float32)
+    or as float16 (2x smaller), in memory-mapped .npy files, so that millions of them can be kept without
+    loading them into memory. Distances are computed on the quantized codes, by factoring the scales out
+    of the dot products, and in chunks, so that the memory usage stays bounded.
+    """
+    def __init__(self, path, chunk_size=65536):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode='r')
+        # square norms of the dequantized embeddings
+        self.square_norms = np.load(os.path.join(path, 'square_norms.npy'), mmap_mode='r')
+
+    @staticmethod
+    def create(path, embeddings, dtype='int8', chunk_size=65536):
+        """Quantizes the embeddings chunk by chunk into a new store at the given path, and opens it.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        num, dim = embeddings.shape
+        codes = np.lib.format.open_memmap(os.path.join(path, 'codes.npy'), mode='w+',
+                                          dtype=np.dtype(dtype), shape=(num, dim))
+        scales = np.lib.format.open_memmap(os.path.join(path, 'scales.npy'), mode='w+',
+                                           dtype=np.float32, shape=(num,))
+        square_norms = np.lib.format.open_memmap(os.path.join(path, 'square_norms.npy'), mode='w+',
+                                                 dtype=np.float32, shape=(num,))
+        for start in range(0, num, chunk_size):
+            chunk_codes, chunk_scales = quantize(embeddings[start:start + chunk_size], dtype)
+            codes[start:start + len(chunk_codes)] = chunk_codes
+            scales[start:start + len(chunk_codes)] = chunk_scales
+            square_norms[start:start + len(chunk_codes)] = \
+                np.sum(np.square(chunk_codes.astype(np.float32)), axis=1) * np.square(chunk_scales)
+        # flush the files, before opening them read-only
+        del codes, scales, square_norms
+        return EmbeddingStore(path, chunk_size)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes + self.square_norms.nbytes
+
+    def dequantize(self, indices):
+        return self.codes[indices].astype(np.float32) * self.scales[indices][:, np.newaxis]
+
+    def distances(self, queries):
+        """Returns the (queries x store) matrix of euclidean distances between float32 queries
+        and all stored embeddings.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        query_square_norms = np.sum(np.square(queries), axis=1)[:, np.newaxis]
+        distances = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), self.chunk_size):
+            end = min(start + self.chunk_size, len(self))
+            # q * (s * c) = s * (q * c)
+            dot_products = np.dot(queries, self.codes[start:end].T.astype(np.float32)) * self.scales[start:end]
+            sum_square = query_square_norms + self.square_norms[start:end] - 2 * dot_products
+            distances[:, start:end] = np.sqrt(np.maximum(sum_square, utils.EPSILON))
+        return distances
+
+    def pair_distances(self, pair_indices):
+        """Returns the euclidean distances of the given (N x 2) index pairs of stored embeddings.
+        """
+        distances = np.empty(len(pair_indices), dtype=np.float32)
+        for start in range(0, len(pair_indices), self.chunk_size):
+            batch = pair_indices[start:start + self.chunk_size]
+            a, b = batch[:, 0], batch[:, 1]
+            codes_a = self.codes[a].astype(np.float32)
+            codes_b = self.codes[b].astype(np.float32)
+            # s_a * s_b * (c_a * c_b) replaces the dot product of the dequantized embeddings
+            dot_products = np.sum(codes_a * codes_b, axis=1) * self.scales[a] * self.scales[b]
+            sum_square = self.square_norms[a] + self.square_norms[b] - 2 * dot_products
+            distances[start:start + len(batch)] = np.sqrt(np.maximum(sum_square, utils.EPSILON))
+        return distances
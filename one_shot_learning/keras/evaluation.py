@@ -0,0 +1,106 @@
+import numpy as np
+
+
+def _positive_scores(predictions, is_distance):
+    """Returns scores, where higher means more likely to be a positive (same class) pair.
+    """
+    scores = np.ravel(predictions).astype(np.float64)
+    return -scores if is_distance else scores
+
+
+def roc_auc(y_true, scores):
+    """Area under the ROC curve, computed from the ranks of the scores (ties get their average rank).
+    """
+    positives = np.ravel(y_true) == 1
+    num_positives = np.sum(positives)
+    num_negatives = len(positives) - num_positives
+    if num_positives == 0 or num_negatives == 0:
+        return np.nan
+    _, inverse, counts = np.unique(scores, return_inverse=True, return_counts=True)
+    average_ranks = np.cumsum(counts) - (counts - 1) / 2.0
+    rank_sum = np.sum(average_ranks[inverse][positives])
+    return (rank_sum - num_positives * (num_positives + 1) / 2.0) / (num_positives * num_negatives)
+
+
+def threshold_sweep(y_true, predictions, is_distance, thresholds):
+    """Returns the true positive rates, false positive rates and accuracies for all thresholds,
+    using sorted scores instead of re-thresholding the predictions for each threshold.
+    """
+    positives = np.ravel(y_true) == 1
+    scores = _positive_scores(predictions, is_distance)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    score_thresholds = -thresholds if is_distance else thresholds
+
+    positive_scores = np.sort(scores[positives])
+    negative_scores = np.sort(scores[~positives])
+    # number of pairs, whose score is above each threshold
+    tp = len(positive_scores) - np.searchsorted(positive_scores, score_thresholds, side='right')
+    fp = len(negative_scores) - np.searchsorted(negative_scores, score_thresholds, side='right')
+    tn = len(negative_scores) - fp
+
+    tpr = tp / float(max(len(positive_scores), 1))
+    fpr = fp / float(max(len(negative_scores), 1))
+    accuracy = (tp + tn) / float(max(len(scores), 1))
+    return tpr, fpr, accuracy
+
+
+def evaluate(y_true, predictions, threshold, is_distance, k=10, thresholds=None):
+    """Computes the confusion statistics at the given threshold, a threshold sweep (ROC) and
+    the indices of the k hardest false positives and false negatives.
+    For distances (is_distance=True), a pair is predicted as positive if its distance is below the threshold,
+    otherwise if its prediction is above the threshold.
+    """
+    y_true = np.ravel(y_true)
+    positives = y_true == 1
+    scores = _positive_scores(predictions, is_distance)
+    score_threshold = -threshold if is_distance else threshold
+    predicted_positives = scores > score_threshold
+
+    tp = np.sum(predicted_positives & positives)
+    fp = np.sum(predicted_positives & ~positives)
+    tn = np.sum(~predicted_positives & ~positives)
+    fn = np.sum(~predicted_positives & positives)
+
+    # the hardest false positives have the highest, the hardest false negatives the lowest scores
+    fp_indices = np.where(predicted_positives & ~positives)[0]
+    fp_indices = fp_indices[np.argsort(-scores[fp_indices], kind='mergesort')[:k]]
+    fn_indices = np.where(~predicted_positives & positives)[0]
+    fn_indices = fn_indices[np.argsort(scores[fn_indices], kind='mergesort')[:k]]
+
+    if thresholds is None:
+        predictions = np.ravel(predictions)
+        thresholds = np.linspace(np.min(predictions), np.max(predictions), 101)
+    tpr, fpr, accuracies = threshold_sweep(y_true, predictions, is_distance, thresholds)
+    best = np.argmax(accuracies)
+
+    return {
+        'threshold': threshold,
+        'tp': tp,
+        'fp': fp,
+        'tn': tn,
+        'fn': fn,
+        'accuracy': (tp + tn) / float(max(len(y_true), 1)),
+        'precision': tp / float(max(tp + fp, 1)),
+        'recall': tp / float(max(tp + fn, 1)),
+        'false_positive_rate': fp / float(max(fp + tn, 1)),
+        'auc': roc_auc(y_true, scores),
+        'thresholds': thresholds,
+        'tpr': tpr,
+        'fpr': fpr,
+        'accuracies': accuracies,
+        'best_threshold': thresholds[best],
+        'best_accuracy': accuracies[best],
+        'false_positives': fp_indices,
+        'false_negatives': fn_indices,
+    }
+
+
+def print_report(report):
+    print('>>> Threshold: {:.4f}'.format(report['threshold']))
+    print('>>> TP: {}, FP: {}, TN: {}, FN: {}'.format(report['tp'], report['fp'], report['tn'], report['fn']))
+    print('>>> Accuracy: {:.2f}%, Precision: {:.2f}%, Recall: {:.2f}%, FPR: {:.2f}%'.format(
+        report['accuracy'] * 100, report['precision'] * 100, report['recall'] * 100,
+        report['false_positive_rate'] * 100))
+    print('>>> ROC AUC: {:.4f}'.format(report['auc']))
+    print('>>> Best threshold: {:.4f} (accuracy: {:.2f}%)'.format(report['best_threshold'],
+                                                                  report['best_accuracy'] * 100))
@@ -5,11 +5,15 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import functools
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
+import one_shot_learning.keras.evaluation as evaluation
+import one_shot_learning.keras.utils as utils
+
 DISTANCE_THRESHOLD = 0.50
 NUM_CLASSES = 100
 SEED = 42
@@ -21,29 +25,6 @@ def l1_distance_vector(vects):
     return tf.keras.backend.maximum(l1, tf.keras.backend.epsilon())
 
 
-def create_pairs(x, digit_indices, oversample_factor=1):
-    """Positive and negative pair creation.
-    Alternates between positive and negative pairs.
-    """
-    pairs = []
-    labels = []
-    n = min([len(digit_indices[d]) for d in range(NUM_CLASSES)])
-    for o in range(oversample_factor):
-        for d in range(NUM_CLASSES):
-            for i in range(n - 1):
-                for j in range(i + 1, n):
-                    z1, z2 = digit_indices[d][i], digit_indices[d][j]
-                    pairs += [[x[z1], x[z2]]]
-
-                    rand_inc = np.random.randint(1, NUM_CLASSES)
-                    rand_idx = np.random.randint(0, len(digit_indices[d]))
-                    dn = (d + rand_inc) % NUM_CLASSES
-                    z1, z2 = digit_indices[d][i], digit_indices[dn][rand_idx]
-                    pairs += [[x[z1], x[z2]]]
-                    labels += [1, 0]
-    return np.array(pairs), np.array(labels)
-
-
 def create_base_cnn_network(input_shape):
     """Base CNN network to be shared (eq. to feature extraction).
     """
@@ -66,20 +47,18 @@ def create_base_cnn_network(input_shape):
     x = tf.keras.layers.Activation('relu')(x)
     x = tf.keras.layers.Dropout(0.5)(x)
     x = tf.keras.layers.Dense(128, activation='relu', kernel_regularizer=tf.keras.regularizers.l2(5e-4))(x)
-    return tf.keras.models.Model(inputs, x)
+    return tf.keras.models.Model(inputs, x, name='base_network')
 
 
 def create_dense_siamese_model(input_shape):
     base_network = create_base_cnn_network(input_shape)
 
-    input_a = tf.keras.layers.Input(shape=input_shape)
-    input_b = tf.keras.layers.Input(shape=input_shape)
-
-    processed_a = base_network(input_a)
-    processed_b = base_network(input_b)
+    # the head works on embeddings only, so that it can also score cached embeddings
+    embedding_a = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    embedding_b = tf.keras.layers.Input(shape=base_network.output_shape[1:])
 
     # output_shape=lambda x: x[0]
-    embedding = tf.keras.layers.Lambda(l1_distance_vector)([processed_a, processed_b])
+    embedding = tf.keras.layers.Lambda(l1_distance_vector)([embedding_a, embedding_b])
     embedding = tf.keras.layers.BatchNormalization()(embedding)
     x = tf.keras.layers.Dropout(0.5)(embedding)
     x = tf.keras.layers.Dense(512, kernel_regularizer=tf.keras.regularizers.l2(5e-4))(x)
@@ -88,7 +67,14 @@ def create_dense_siamese_model(input_shape):
     x = tf.keras.layers.Dropout(0.5)(x)
     prediction = tf.keras.layers.Dense(1, kernel_regularizer=tf.keras.regularizers.l2(5e-4),
                                        activation='sigmoid')(x)
-    model = tf.keras.models.Model([input_a, input_b], prediction)
+    head = tf.keras.models.Model([embedding_a, embedding_b], prediction, name='head')
+
+    input_a = tf.keras.layers.Input(shape=input_shape)
+    input_b = tf.keras.layers.Input(shape=input_shape)
+
+    processed_a = base_network(input_a)
+    processed_b = base_network(input_b)
+    model = tf.keras.models.Model([input_a, input_b], head([processed_a, processed_b]), name='siamese')
 
     opt = tf.keras.optimizers.RMSprop()
     model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
@@ -99,16 +85,13 @@ def create_dense_siamese_model(input_shape):
 def create_per_feature_nn_siamese_model(input_shape):
     base_network = create_base_cnn_network(input_shape)
 
-    input_a = tf.keras.layers.Input(shape=input_shape)
-    input_b = tf.keras.layers.Input(shape=input_shape)
-
-    processed_a = base_network(input_a)
-    processed_b = base_network(input_b)
+    embedding_a = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    embedding_b = tf.keras.layers.Input(shape=base_network.output_shape[1:])
 
     mid = 32
-    x1 = tf.keras.layers.Lambda(lambda x: x[0] * x[1])([processed_a, processed_b])
-    x2 = tf.keras.layers.Lambda(lambda x: x[0] + x[1])([processed_a, processed_b])
-    x3 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.abs(x[0] - x[1]))([processed_a, processed_b])
+    x1 = tf.keras.layers.Lambda(lambda x: x[0] * x[1])([embedding_a, embedding_b])
+    x2 = tf.keras.layers.Lambda(lambda x: x[0] + x[1])([embedding_a, embedding_b])
+    x3 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.abs(x[0] - x[1]))([embedding_a, embedding_b])
     x4 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.square(x))(x3)
     x = tf.keras.layers.Concatenate()([x1, x2, x3, x4])
     x = tf.keras.layers.Reshape((4, base_network.output_shape[1], 1), name='reshape1')(x)
@@ -121,7 +104,14 @@ def create_per_feature_nn_siamese_model(input_shape):
 
     # Weighted sum implemented as a Dense layer.
     x = tf.keras.layers.Dense(1, use_bias=True, activation='sigmoid', name='weighted-average')(x)
-    model = tf.keras.models.Model([input_a, input_b], x, name='head')
+    head = tf.keras.models.Model([embedding_a, embedding_b], x, name='head')
+
+    input_a = tf.keras.layers.Input(shape=input_shape)
+    input_b = tf.keras.layers.Input(shape=input_shape)
+
+    processed_a = base_network(input_a)
+    processed_b = base_network(input_b)
+    model = tf.keras.models.Model([input_a, input_b], head([processed_a, processed_b]), name='siamese')
 
     opt = tf.keras.optimizers.RMSprop()
     model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
@@ -205,10 +195,14 @@ def main(args):
 
     # create training+test positive and negative pairs
     tr_digit_indices = get_digit_indices(y_train, args.examples_per_class)
-    tr_pairs, tr_y = create_pairs(x_train, tr_digit_indices, args.oversample)
+    tr_pair_indices, tr_y = utils.create_pair_indices(tr_digit_indices, args.oversample)
 
     te_digit_indices = get_digit_indices(y_test, args.examples_per_class)
-    te_pairs, te_y = create_pairs(x_test, te_digit_indices, args.oversample)
+    te_pair_indices, te_y = utils.create_pair_indices(te_digit_indices, args.oversample)
+
+    # the images of the pairs are only gathered batch by batch
+    tr_sequence = utils.PairSequence(x_train, tr_pair_indices, tr_y, args.batch_size, shuffle=True)
+    te_sequence = utils.PairSequence(x_test, te_pair_indices, te_y, args.batch_size)
 
     # network definition
     input_shape = x_train.shape[1:]
@@ -236,13 +230,19 @@ def main(args):
         save_weights_only=True,
         period=1))
 
+    if args.input_pipeline == 'dataset':
+        # the pairs are drawn on the fly from the per class indices, with fresh negatives for each epoch
+        tr_dataset, tr_steps = utils.create_pair_dataset(x_train, tr_digit_indices, args.batch_size, args.oversample)
+        te_dataset, te_steps = utils.create_pair_index_dataset(x_test, te_pair_indices, te_y, args.batch_size)
+        fit = functools.partial(model.fit, tr_dataset, steps_per_epoch=tr_steps,
+                                validation_data=te_dataset, validation_steps=te_steps)
+    else:
+        fit = functools.partial(model.fit_generator, tr_sequence, validation_data=te_sequence)
+
     print('Training...')
-    history = model.fit([tr_pairs[:, 0], tr_pairs[:, 1]], tr_y,
-                        batch_size=args.batch_size,
-                        epochs=args.max_epochs,
-                        callbacks=callbacks,
-                        verbose=2,
-                        validation_data=([te_pairs[:, 0], te_pairs[:, 1]], te_y))
+    history = fit(epochs=args.max_epochs,
+                  callbacks=callbacks,
+                  verbose=2)
 
     plot_values(history.history['loss'], history.history['val_loss'], 'Loss')
     plot_values(history.history['acc'], history.history['val_acc'], 'Accuracy')
@@ -251,65 +251,52 @@ def main(args):
     latest = tf.train.latest_checkpoint('checkpoints')
     model.load_weights(latest)
 
+    if args.export_dir:
+        # the base network and the head can be loaded separately using `utils.load_siamese_model`,
+        # which is checked by scoring some test pairs with the loaded models
+        utils.export_siamese_model(model, args.export_dir)
+        pair_indices = te_pair_indices[:32]
+        difference = utils.check_siamese_export(model, args.export_dir, x_test[pair_indices[:, 0]],
+                                                x_test[pair_indices[:, 1]])
+        print('Max. difference of the exported model scores: {:.6f}'.format(difference))
+
     # compute final accuracy on training and test sets
-    tr_pred = model.predict([tr_pairs[:, 0], tr_pairs[:, 1]])
-    te_pred = model.predict([te_pairs[:, 0], te_pairs[:, 1]])
+    tr_eval_sequence = utils.PairSequence(x_train, tr_pair_indices, tr_y, args.batch_size)
+    tr_pred = model.predict_generator(tr_eval_sequence)
+    te_pred = model.predict_generator(te_sequence)
 
     if args.model == 'simple_head':
         tr_acc = compute_accuracy(tr_y, tr_pred)
         te_acc = compute_accuracy(te_y, te_pred)
     else:
-        tr_scores = model.evaluate([tr_pairs[:, 0], tr_pairs[:, 1]], tr_y, verbose=2)
+        tr_scores = model.evaluate_generator(tr_eval_sequence)
         tr_acc = tr_scores[1]
-        te_scores = model.evaluate([te_pairs[:, 0], te_pairs[:, 1]], te_y, verbose=2)
+        te_scores = model.evaluate_generator(te_sequence)
         te_acc = te_scores[1]
 
     print('>>> Accuracy on training set: {:.2f}%'.format(tr_acc * 100))
     print('>>> Accuracy on test set:     {:.2f}%'.format(te_acc * 100))
 
     # plot first 20 examples
-    image_pairs = te_pairs[:20, :]
+    image_pairs = utils.gather_pairs(x_test, te_pair_indices[:20])
     labels = te_y[:20]
     predictions = te_pred[:20]
 
     plot_examples_separated(image_pairs, labels, predictions)
 
-    # plot first 10 FPs
-    if args.model == 'simple_head':
-        # minimum
-        assessment_criteria = lambda new, prev: new < prev
-    else:
-        # maximum
-        assessment_criteria = lambda new, prev: new > prev
+    # confusion statistics, threshold sweep and hardest errors
+    report = evaluation.evaluate(te_y, te_pred, DISTANCE_THRESHOLD, is_distance=args.model == 'simple_head')
+    evaluation.print_report(report)
+
+    # plot the 10 hardest FPs
+    if len(report['false_positives']) > 0:
+        indices = report['false_positives']
+        plot_examples(utils.gather_pairs(x_test, te_pair_indices[indices]), te_pred[indices])
 
-    image_pairs = []
-    labels = np.zeros(10)
-    predictions = np.zeros((10, 1))
-    index = 0
-    while len(image_pairs) < 10:
-        if assessment_criteria(te_pred[index], DISTANCE_THRESHOLD) and te_y[index] == 0:
-            image_pairs += [[te_pairs[index, 0], te_pairs[index, 1]]]
-            labels[len(image_pairs) - 1] = te_y[index]
-            predictions[len(image_pairs) - 1, 0] = te_pred[index, 0]
-        index += 1
-    image_pairs = np.array(image_pairs)
-
-    plot_examples(image_pairs, predictions)
-
-    # plot first 10 FNs
-    image_pairs = []
-    labels = np.zeros(10)
-    predictions = np.zeros((10, 1))
-    index = 0
-    while len(image_pairs) < 10:
-        if not assessment_criteria(te_pred[index], DISTANCE_THRESHOLD) and te_y[index] == 1:
-            image_pairs += [[te_pairs[index, 0], te_pairs[index, 1]]]
-            labels[len(image_pairs) - 1] = te_y[index]
-            predictions[len(image_pairs) - 1, 0] = te_pred[index, 0]
-        index += 1
-    image_pairs = np.array(image_pairs)
-
-    plot_examples(image_pairs, predictions)
+    # plot the 10 hardest FNs
+    if len(report['false_negatives']) > 0:
+        indices = report['false_negatives']
+        plot_examples(utils.gather_pairs(x_test, te_pair_indices[indices]), te_pred[indices])
 
     # classify (using minimum distance)
     print('Classifying test set...')
@@ -379,6 +366,11 @@ if __name__ == '__main__':
     parser.add_argument('--model', choices=['dense_head', 'per_feature_nn'], type=str,
                         default='dense_head',
                         help='The network model of the siamese, which mainly differs in the head model used')
+    parser.add_argument('--input_pipeline', choices=['sequence', 'dataset'], type=str, default='sequence',
+                        help='Whether to train on the fixed pairs, or on pairs that are streamed by a tf.data ' +
+                             'pipeline with fresh negative pairs for each epoch')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='If set, the trained base network and head are exported to this directory')
     parser.add_argument('--early_stopping', type=bool, default=True,
                         help='Whether to use early stopping or not')
     parser.add_argument('--oversample', type=int, default=2,
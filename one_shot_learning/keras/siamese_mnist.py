@@ -5,11 +5,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import functools
+import os
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
+import one_shot_learning.keras.embedding_store as embedding_store
+import one_shot_learning.keras.evaluation as evaluation
+import one_shot_learning.keras.support_index as support_index
+import one_shot_learning.keras.utils as utils
+
 DISTANCE_THRESHOLD = 0.50
 NUM_CLASSES = 10
 SEED = 42
@@ -37,27 +44,56 @@ def contrastive_loss(y_true, y_pred):
     return tf.keras.backend.mean(y_true * sqaure_pred + (1 - y_true) * margin_square)
 
 
-def create_pairs(x, digit_indices, oversample_factor=1):
-    """Positive and negative pair creation.
-    Alternates between positive and negative pairs.
+def pairwise_distances(embeddings):
+    """Computes the (B x B) matrix of euclidean distances between all embeddings of a batch.
     """
-    pairs = []
-    labels = []
-    n = min([len(digit_indices[d]) for d in range(NUM_CLASSES)])
-    for o in range(oversample_factor):
-        for d in range(NUM_CLASSES):
-            for i in range(n - 1):
-                for j in range(i + 1, n):
-                    z1, z2 = digit_indices[d][i], digit_indices[d][j]
-                    pairs += [[x[z1], x[z2]]]
+    dot_product = tf.matmul(embeddings, embeddings, transpose_b=True)
+    square_norm = tf.diag_part(dot_product)
+    sum_square = tf.expand_dims(square_norm, 1) - 2.0 * dot_product + tf.expand_dims(square_norm, 0)
+    return tf.keras.backend.sqrt(tf.keras.backend.maximum(sum_square, tf.keras.backend.epsilon()))
 
-                    rand_inc = np.random.randint(1, NUM_CLASSES)
-                    rand_idx = np.random.randint(0, len(digit_indices[d]))
-                    dn = (d + rand_inc) % NUM_CLASSES
-                    z1, z2 = digit_indices[d][i], digit_indices[dn][rand_idx]
-                    pairs += [[x[z1], x[z2]]]
-                    labels += [1, 0]
-    return np.array(pairs), np.array(labels)
+
+def pair_masks(labels):
+    """Returns the masks of all valid positive pairs (same label, but not the identical example)
+    and of all negative pairs (different label) within a batch.
+    """
+    labels = tf.reshape(tf.cast(labels, tf.int32), [-1])
+    same_label = tf.equal(tf.expand_dims(labels, 0), tf.expand_dims(labels, 1))
+    not_identical = tf.logical_not(tf.cast(tf.eye(tf.shape(labels)[0]), tf.bool))
+    positive_mask = tf.to_float(tf.logical_and(same_label, not_identical))
+    negative_mask = tf.to_float(tf.logical_not(same_label))
+    return positive_mask, negative_mask
+
+
+def batch_all_contrastive_loss(y_true, y_pred):
+    """Contrastive loss over all valid pairs of a batch, where y_true are the labels
+    and y_pred the embeddings of the images.
+    """
+    margin = 1
+    distances = pairwise_distances(y_pred)
+    positive_mask, negative_mask = pair_masks(y_true)
+    margin_square = tf.square(tf.keras.backend.maximum(margin - distances, 0))
+    loss = positive_mask * tf.square(distances) + negative_mask * margin_square
+    return tf.reduce_sum(loss) / tf.keras.backend.maximum(tf.reduce_sum(positive_mask + negative_mask), 1.0)
+
+
+def batch_hard_triplet_loss(y_true, y_pred):
+    """Triplet loss using the hardest positive and the hardest negative of each anchor in a batch,
+    where y_true are the labels and y_pred the embeddings of the images.
+    """
+    margin = 1
+    distances = pairwise_distances(y_pred)
+    positive_mask, negative_mask = pair_masks(y_true)
+    hardest_positive = tf.reduce_max(positive_mask * distances, axis=1)
+    # push the distances of non-negatives above every other distance, before taking the minimum
+    max_distance = tf.reduce_max(distances, axis=1, keepdims=True)
+    hardest_negative = tf.reduce_min(distances + max_distance * (1.0 - negative_mask), axis=1)
+    loss = tf.keras.backend.maximum(hardest_positive - hardest_negative + margin, 0)
+
+    # anchors without any positive or negative in the batch do not form a triplet
+    valid = tf.to_float(tf.logical_and(tf.reduce_any(positive_mask > 0, axis=1),
+                                       tf.reduce_any(negative_mask > 0, axis=1)))
+    return tf.reduce_sum(loss * valid) / tf.keras.backend.maximum(tf.reduce_sum(valid), 1.0)
 
 
 def create_base_nn_network(input_shape):
@@ -74,7 +110,7 @@ def create_base_nn_network(input_shape):
     x = tf.keras.layers.Activation('relu')(x)
     x = tf.keras.layers.Dropout(0.225)(x)
     x = tf.keras.layers.Dense(128, activation='relu', kernel_regularizer=tf.keras.regularizers.l2(5e-6))(x)
-    return tf.keras.models.Model(inputs, x)
+    return tf.keras.models.Model(inputs, x, name='base_network')
 
 
 def create_base_cnn_network(input_shape):
@@ -99,7 +135,7 @@ def create_base_cnn_network(input_shape):
     x = tf.keras.layers.Activation('relu')(x)
     x = tf.keras.layers.Dropout(0.5)(x)
     x = tf.keras.layers.Dense(128, activation='relu', kernel_regularizer=tf.keras.regularizers.l2(5e-4))(x)
-    return tf.keras.models.Model(inputs, x)
+    return tf.keras.models.Model(inputs, x, name='base_network')
 
 
 def create_base_fcn_network(input_shape):
@@ -142,7 +178,7 @@ def create_base_fcn_network(input_shape):
     x = tf.keras.layers.Activation('relu')(x)
     x = tf.keras.layers.Dropout(0.5)(x)
     x = tf.keras.layers.Flatten()(x)
-    return tf.keras.models.Model(inputs, x)
+    return tf.keras.models.Model(inputs, x, name='base_network')
 
 
 def create_simple_siamese_model(base_network_model, input_shape):
@@ -155,6 +191,12 @@ def create_simple_siamese_model(base_network_model, input_shape):
     else:
         raise Exception('Unknown base network model type.')
 
+    # the head works on embeddings only, so that it can also score cached embeddings
+    embedding_a = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    embedding_b = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    distance = tf.keras.layers.Lambda(euclidean_distance_scalar)([embedding_a, embedding_b])
+    head = tf.keras.models.Model([embedding_a, embedding_b], distance, name='head')
+
     input_a = tf.keras.layers.Input(shape=input_shape)
     input_b = tf.keras.layers.Input(shape=input_shape)
     # because we re-use the same instance `base_network`,
@@ -162,8 +204,7 @@ def create_simple_siamese_model(base_network_model, input_shape):
     # will be shared across the two branches
     processed_a = base_network(input_a)
     processed_b = base_network(input_b)
-    distance = tf.keras.layers.Lambda(euclidean_distance_scalar)([processed_a, processed_b])
-    model = tf.keras.models.Model([input_a, input_b], distance)
+    model = tf.keras.models.Model([input_a, input_b], head([processed_a, processed_b]), name='siamese')
 
     opt = tf.keras.optimizers.RMSprop()  # performed much better than Adam
     model.compile(loss=contrastive_loss, optimizer=opt, metrics=[acc])
@@ -181,14 +222,11 @@ def create_dense_siamese_model(base_network_model, input_shape):
     else:
         raise Exception('Unknown base network model type.')
 
-    input_a = tf.keras.layers.Input(shape=input_shape)
-    input_b = tf.keras.layers.Input(shape=input_shape)
-
-    processed_a = base_network(input_a)
-    processed_b = base_network(input_b)
+    embedding_a = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    embedding_b = tf.keras.layers.Input(shape=base_network.output_shape[1:])
 
     # output_shape=lambda x: x[0]
-    embedding = tf.keras.layers.Lambda(l1_distance_vector)([processed_a, processed_b])
+    embedding = tf.keras.layers.Lambda(l1_distance_vector)([embedding_a, embedding_b])
     embedding = tf.keras.layers.BatchNormalization()(embedding)
     x = tf.keras.layers.Dropout(0.5)(embedding)
     x = tf.keras.layers.Dense(512, kernel_regularizer=tf.keras.regularizers.l2(5e-4))(x)
@@ -197,7 +235,14 @@ def create_dense_siamese_model(base_network_model, input_shape):
     x = tf.keras.layers.Dropout(0.5)(x)
     prediction = tf.keras.layers.Dense(1, kernel_regularizer=tf.keras.regularizers.l2(5e-4),
                                        activation='sigmoid')(x)
-    model = tf.keras.models.Model([input_a, input_b], prediction)
+    head = tf.keras.models.Model([embedding_a, embedding_b], prediction, name='head')
+
+    input_a = tf.keras.layers.Input(shape=input_shape)
+    input_b = tf.keras.layers.Input(shape=input_shape)
+
+    processed_a = base_network(input_a)
+    processed_b = base_network(input_b)
+    model = tf.keras.models.Model([input_a, input_b], head([processed_a, processed_b]), name='siamese')
 
     opt = tf.keras.optimizers.RMSprop()
     model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
@@ -215,16 +260,13 @@ def create_per_feature_nn_siamese_model(base_network_model, input_shape):
     else:
         raise Exception('Unknown base network model type.')
 
-    input_a = tf.keras.layers.Input(shape=input_shape)
-    input_b = tf.keras.layers.Input(shape=input_shape)
-
-    processed_a = base_network(input_a)
-    processed_b = base_network(input_b)
+    embedding_a = tf.keras.layers.Input(shape=base_network.output_shape[1:])
+    embedding_b = tf.keras.layers.Input(shape=base_network.output_shape[1:])
 
     mid = 32
-    x1 = tf.keras.layers.Lambda(lambda x: x[0] * x[1])([processed_a, processed_b])
-    x2 = tf.keras.layers.Lambda(lambda x: x[0] + x[1])([processed_a, processed_b])
-    x3 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.abs(x[0] - x[1]))([processed_a, processed_b])
+    x1 = tf.keras.layers.Lambda(lambda x: x[0] * x[1])([embedding_a, embedding_b])
+    x2 = tf.keras.layers.Lambda(lambda x: x[0] + x[1])([embedding_a, embedding_b])
+    x3 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.abs(x[0] - x[1]))([embedding_a, embedding_b])
     x4 = tf.keras.layers.Lambda(lambda x: tf.keras.backend.square(x))(x3)
     x = tf.keras.layers.Concatenate()([x1, x2, x3, x4])
     x = tf.keras.layers.Reshape((4, base_network.output_shape[1], 1), name='reshape1')(x)
@@ -237,7 +279,14 @@ def create_per_feature_nn_siamese_model(base_network_model, input_shape):
 
     # Weighted sum implemented as a Dense layer.
     x = tf.keras.layers.Dense(1, use_bias=True, activation='sigmoid', name='weighted-average')(x)
-    model = tf.keras.models.Model([input_a, input_b], x, name='head')
+    head = tf.keras.models.Model([embedding_a, embedding_b], x, name='head')
+
+    input_a = tf.keras.layers.Input(shape=input_shape)
+    input_b = tf.keras.layers.Input(shape=input_shape)
+
+    processed_a = base_network(input_a)
+    processed_b = base_network(input_b)
+    model = tf.keras.models.Model([input_a, input_b], head([processed_a, processed_b]), name='siamese')
 
     opt = tf.keras.optimizers.RMSprop()
     model.compile(loss='binary_crossentropy', optimizer=opt, metrics=['accuracy'])
@@ -307,48 +356,31 @@ def plot_examples(image_pairs, predictions):
     plt.show()
 
 
-def main(args):
-    # results can still be non-deterministic when running on GPU, due to cuDNN
-    tf.set_random_seed(SEED)
-    np.random.seed(SEED)
-
-    # the data, split between train and test sets
-    (x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
-    x_train = np.expand_dims(x_train, axis=-1).astype('float32')
-    x_test = np.expand_dims(x_test, axis=-1).astype('float32')
-    x_train /= 255
-    x_test /= 255
-
-    # create training+test positive and negative pairs
-    tr_digit_indices = get_digit_indices(y_train, args.examples_per_class)
-    tr_pairs, tr_y = create_pairs(x_train, tr_digit_indices, args.oversample)
-
-    te_digit_indices = get_digit_indices(y_test, args.examples_per_class)
-    te_pairs, te_y = create_pairs(x_test, te_digit_indices, args.oversample)
-
-    # network definition
-    input_shape = x_train.shape[1:]
-
-    if args.model == 'simple_head':
-        model = create_simple_siamese_model(args.base_network, input_shape)
-    elif args.model == 'dense_head':
-        model = create_dense_siamese_model(args.base_network, input_shape)
-    elif args.model == 'per_feature_nn':
-        model = create_per_feature_nn_siamese_model(args.base_network, input_shape)
+def train_in_batch(base_network, args, x_train, tr_digit_indices, x_test, te_digit_indices):
+    """Trains the base network with a loss over the (B x B) distance matrix of each batch, so that each image
+    is embedded only once per batch, instead of once per pair it appears in.
+    """
+    if args.training == 'batch_all':
+        loss = batch_all_contrastive_loss
+    elif args.training == 'batch_hard':
+        loss = batch_hard_triplet_loss
     else:
-        raise Exception('Unknown model type.')
+        raise Exception('Unknown training type.')
 
-    model.summary()
+    opt = tf.keras.optimizers.RMSprop()
+    base_network.compile(loss=loss, optimizer=opt)
 
-    # train
+    num_classes_per_batch = max(2, args.batch_size // 4)
+    tr_sequence = utils.ClassBatchSequence(x_train, tr_digit_indices, num_classes_per_batch)
+    te_sequence = utils.ClassBatchSequence(x_test, te_digit_indices, num_classes_per_batch)
 
     callbacks = []
     if args.early_stopping:
-        callbacks.append(tf.keras.callbacks.EarlyStopping(patience=20, monitor='val_acc'))
-    callbacks.append(tf.keras.callbacks.ReduceLROnPlateau(monitor='val_acc', factor=0.5, patience=10, verbose=1))
+        callbacks.append(tf.keras.callbacks.EarlyStopping(patience=20, monitor='val_loss'))
+    callbacks.append(tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.5, patience=10, verbose=1))
     callbacks.append(tf.keras.callbacks.ModelCheckpoint(
         filepath='checkpoints/ckp',
-        monitor='val_acc',
+        monitor='val_loss',
         verbose=1,
         save_best_only=True,
         save_weights_only=True,
@@ -356,92 +388,38 @@ def main(args):
 
     if args.min_epochs:
         print('Pre-training...')
-        # we pre-train the model (some steps without early stopping), because it takes a while
-        # until the accuracy starts to improve
-        model.fit([tr_pairs[:, 0], tr_pairs[:, 1]], tr_y,
-                  batch_size=args.batch_size,
-                  epochs=args.min_epochs,
-                  verbose=2,
-                  validation_data=([te_pairs[:, 0], te_pairs[:, 1]], te_y))
+        # like the pair training, the first epochs are run without early stopping
+        base_network.fit_generator(tr_sequence, epochs=args.min_epochs, verbose=2, validation_data=te_sequence)
 
     print('Training...')
-    history = model.fit([tr_pairs[:, 0], tr_pairs[:, 1]], tr_y,
-                        batch_size=args.batch_size,
-                        epochs=args.max_epochs,
-                        initial_epoch=args.min_epochs,
-                        callbacks=callbacks,
-                        verbose=2,
-                        validation_data=([te_pairs[:, 0], te_pairs[:, 1]], te_y))
-
-    plot_values(history.history['loss'], history.history['val_loss'], 'Loss')
-    plot_values(history.history['acc'], history.history['val_acc'], 'Accuracy')
-
-    # load the best model from checkpoint
-    latest = tf.train.latest_checkpoint('checkpoints')
-    model.load_weights(latest)
-
-    # compute final accuracy on training and test sets
-    tr_pred = model.predict([tr_pairs[:, 0], tr_pairs[:, 1]])
-    te_pred = model.predict([te_pairs[:, 0], te_pairs[:, 1]])
+    return base_network.fit_generator(tr_sequence,
+                                      epochs=args.max_epochs,
+                                      initial_epoch=args.min_epochs,
+                                      callbacks=callbacks,
+                                      verbose=2,
+                                      validation_data=te_sequence)
 
-    if args.model == 'simple_head':
-        tr_acc = compute_accuracy(tr_y, tr_pred)
-        te_acc = compute_accuracy(te_y, te_pred)
-    else:
-        tr_scores = model.evaluate([tr_pairs[:, 0], tr_pairs[:, 1]], tr_y, verbose=2)
-        tr_acc = tr_scores[1]
-        te_scores = model.evaluate([te_pairs[:, 0], te_pairs[:, 1]], te_y, verbose=2)
-        te_acc = te_scores[1]
 
-    print('>>> Accuracy on training set: {:.2f}%'.format(tr_acc * 100))
-    print('>>> Accuracy on test set:     {:.2f}%'.format(te_acc * 100))
-
-    # plot first 20 examples
-    image_pairs = te_pairs[:20, :]
-    labels = te_y[:20]
-    predictions = te_pred[:20]
+def report_quantized_accuracy(base_network, x, pair_indices, y, store_dir, batch_size=4096):
+    """Compares the accuracy of the distances of float32 embeddings with the accuracy of the distances
+    computed on int8 and float16 embedding stores.
+    """
+    embeddings = base_network.predict(x, batch_size=batch_size)
+    sum_square = np.sum(np.square(embeddings[pair_indices[:, 0]] - embeddings[pair_indices[:, 1]]), axis=1)
+    float_acc = compute_accuracy(y, np.sqrt(np.maximum(sum_square, tf.keras.backend.epsilon())))
+    print('>>> Accuracy using float32 embeddings: {:.2f}% ({} bytes)'.format(float_acc * 100, embeddings.nbytes))
 
-    plot_examples_separated(image_pairs, labels, predictions)
+    for dtype in ['float16', 'int8']:
+        store = embedding_store.EmbeddingStore.create(os.path.join(store_dir, dtype), embeddings, dtype)
+        store_acc = compute_accuracy(y, store.pair_distances(pair_indices))
+        print('>>> Accuracy using {} embeddings: {:.2f}% (delta: {:+.2f}%, {} bytes)'.format(
+            dtype, store_acc * 100, (store_acc - float_acc) * 100, store.nbytes))
 
-    # plot first 10 FPs
-    if args.model == 'simple_head':
-        # minimum
-        assessment_criteria = lambda new, prev: new < prev
-    else:
-        # maximum
-        assessment_criteria = lambda new, prev: new > prev
-
-    image_pairs = []
-    labels = np.zeros(10)
-    predictions = np.zeros((10, 1))
-    index = 0
-    while len(image_pairs) < 10:
-        if assessment_criteria(te_pred[index], DISTANCE_THRESHOLD) and te_y[index] == 0:
-            image_pairs += [[te_pairs[index, 0], te_pairs[index, 1]]]
-            labels[len(image_pairs) - 1] = te_y[index]
-            predictions[len(image_pairs) - 1, 0] = te_pred[index, 0]
-        index += 1
-    image_pairs = np.array(image_pairs)
-
-    plot_examples(image_pairs, predictions)
-
-    # plot first 10 FNs
-    image_pairs = []
-    labels = np.zeros(10)
-    predictions = np.zeros((10, 1))
-    index = 0
-    while len(image_pairs) < 10:
-        if not assessment_criteria(te_pred[index], DISTANCE_THRESHOLD) and te_y[index] == 1:
-            image_pairs += [[te_pairs[index, 0], te_pairs[index, 1]]]
-            labels[len(image_pairs) - 1] = te_y[index]
-            predictions[len(image_pairs) - 1, 0] = te_pred[index, 0]
-        index += 1
-    image_pairs = np.array(image_pairs)
-
-    plot_examples(image_pairs, predictions)
 
-    # classify (using minimum distance)
-    print('Classifying test set...')
+def classify_pairwise(model, x_train, tr_digit_indices, x_test, y_test, simple_head):
+    """Classifies each test image by running the full siamese model on (support image, test image) pairs.
+    Returns the classification accuracies using MIN, MEDIAN and MEAN aggregation.
+    """
     min_correct_counter = 0
     median_correct_counter = 0
     mean_correct_counter = 0
@@ -450,7 +428,7 @@ def main(args):
         test_img_label = y_test[t]
         n = min([len(tr_digit_indices[d]) for d in range(NUM_CLASSES)]) - 1
 
-        if args.model == 'simple_head':
+        if simple_head:
             # minimum
             assessment_criteria = lambda new, prev: new < prev
             min_aggregated_distance = 999
@@ -500,9 +478,204 @@ def main(args):
         if test_img_label == mean_aggregated_distance_label:
             mean_correct_counter += 1
 
-    print('Classification accuracy using MIN:    {}'.format(min_correct_counter / x_test.shape[0]))
-    print('Classification accuracy using MEDIAN: {}'.format(median_correct_counter / x_test.shape[0]))
-    print('Classification accuracy using MEAN:   {}'.format(mean_correct_counter / x_test.shape[0]))
+    return (min_correct_counter / x_test.shape[0],
+            median_correct_counter / x_test.shape[0],
+            mean_correct_counter / x_test.shape[0])
+
+
+def classify_cached(model, x_train, tr_digit_indices, x_test, y_test, simple_head, batch_size=4096):
+    """Classifies each test image by scoring cached embeddings.
+    The shared base network runs once over the support set and once over the test set,
+    the head then scores the embeddings in large batches. For the simple head, the distances are
+    computed by a support index over the embeddings instead.
+    Returns the classification accuracies using MIN, MEDIAN and MEAN aggregation.
+    """
+    base_network = model.get_layer('base_network')
+    head = model.get_layer('head')
+
+    n = min([len(tr_digit_indices[d]) for d in range(NUM_CLASSES)]) - 1
+    support_indices = np.concatenate([tr_digit_indices[d][:n] for d in range(NUM_CLASSES)])
+    support_embeddings = base_network.predict(x_train[support_indices], batch_size=batch_size)
+    test_embeddings = base_network.predict(x_test, batch_size=batch_size)
+
+    if simple_head:
+        # the classes of the support set are ordered, so that the columns of the scores are the labels
+        support_labels = np.repeat(np.arange(NUM_CLASSES), n)
+        index = support_index.SupportIndex(support_embeddings, support_labels)
+        min_scores, median_scores, mean_scores = index.class_scores(test_embeddings)
+        min_labels = np.argmin(min_scores, axis=1)
+        median_labels = np.argmin(median_scores, axis=1)
+        mean_labels = np.argmin(mean_scores, axis=1)
+    else:
+        # pairs are ordered as (support image, test image), like in the pairwise classification
+        scores = utils.score_embedding_pairs(head, support_embeddings, test_embeddings, batch_size).T
+
+        # (test image, class, support example)
+        scores = scores.reshape(-1, NUM_CLASSES, n)
+        min_labels = np.argmax(np.min(scores, axis=2), axis=1)
+        median_labels = np.argmax(np.median(scores, axis=2), axis=1)
+        mean_labels = np.argmax(np.mean(scores, axis=2), axis=1)
+
+    y_test = np.ravel(y_test)
+    return np.mean(min_labels == y_test), np.mean(median_labels == y_test), np.mean(mean_labels == y_test)
+
+
+def main(args):
+    # results can still be non-deterministic when running on GPU, due to cuDNN
+    tf.set_random_seed(SEED)
+    np.random.seed(SEED)
+
+    # the data, split between train and test sets
+    (x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
+    x_train = np.expand_dims(x_train, axis=-1).astype('float32')
+    x_test = np.expand_dims(x_test, axis=-1).astype('float32')
+    x_train /= 255
+    x_test /= 255
+
+    # create training+test positive and negative pairs
+    tr_digit_indices = get_digit_indices(y_train, args.examples_per_class)
+    tr_pair_indices, tr_y = utils.create_pair_indices(tr_digit_indices, args.oversample)
+
+    te_digit_indices = get_digit_indices(y_test, args.examples_per_class)
+    te_pair_indices, te_y = utils.create_pair_indices(te_digit_indices, args.oversample)
+
+    # the images of the pairs are only gathered batch by batch
+    tr_sequence = utils.PairSequence(x_train, tr_pair_indices, tr_y, args.batch_size, shuffle=True)
+    te_sequence = utils.PairSequence(x_test, te_pair_indices, te_y, args.batch_size)
+
+    # network definition
+    input_shape = x_train.shape[1:]
+
+    if args.model == 'simple_head':
+        model = create_simple_siamese_model(args.base_network, input_shape)
+    elif args.model == 'dense_head':
+        model = create_dense_siamese_model(args.base_network, input_shape)
+    elif args.model == 'per_feature_nn':
+        model = create_per_feature_nn_siamese_model(args.base_network, input_shape)
+    else:
+        raise Exception('Unknown model type.')
+
+    model.summary()
+
+    # train
+
+    if args.training != 'pairs':
+        if args.model != 'simple_head':
+            raise Exception('In-batch training is only supported by the simple head model.')
+        # the shared base network is trained on its own, the distances of the simple head are based on it
+        base_network = model.get_layer('base_network')
+        history = train_in_batch(base_network, args, x_train, tr_digit_indices, x_test, te_digit_indices)
+
+        plot_values(history.history['loss'], history.history['val_loss'], 'Loss')
+
+        # load the best base network from checkpoint
+        latest = tf.train.latest_checkpoint('checkpoints')
+        base_network.load_weights(latest)
+    else:
+        callbacks = []
+        if args.early_stopping:
+            callbacks.append(tf.keras.callbacks.EarlyStopping(patience=20, monitor='val_acc'))
+        callbacks.append(tf.keras.callbacks.ReduceLROnPlateau(monitor='val_acc', factor=0.5, patience=10, verbose=1))
+        callbacks.append(tf.keras.callbacks.ModelCheckpoint(
+            filepath='checkpoints/ckp',
+            monitor='val_acc',
+            verbose=1,
+            save_best_only=True,
+            save_weights_only=True,
+            period=1))
+
+        if args.input_pipeline == 'dataset':
+            # the pairs are drawn on the fly from the per class indices, with fresh negatives for each epoch
+            tr_dataset, tr_steps = utils.create_pair_dataset(x_train, tr_digit_indices, args.batch_size,
+                                                             args.oversample)
+            te_dataset, te_steps = utils.create_pair_index_dataset(x_test, te_pair_indices, te_y, args.batch_size)
+            fit = functools.partial(model.fit, tr_dataset, steps_per_epoch=tr_steps,
+                                    validation_data=te_dataset, validation_steps=te_steps)
+        else:
+            fit = functools.partial(model.fit_generator, tr_sequence, validation_data=te_sequence)
+
+        if args.min_epochs:
+            print('Pre-training...')
+            # we pre-train the model (some steps without early stopping), because it takes a while
+            # until the accuracy starts to improve
+            fit(epochs=args.min_epochs, verbose=2)
+
+        print('Training...')
+        history = fit(epochs=args.max_epochs,
+                      initial_epoch=args.min_epochs,
+                      callbacks=callbacks,
+                      verbose=2)
+
+        plot_values(history.history['loss'], history.history['val_loss'], 'Loss')
+        plot_values(history.history['acc'], history.history['val_acc'], 'Accuracy')
+
+        # load the best model from checkpoint
+        latest = tf.train.latest_checkpoint('checkpoints')
+        model.load_weights(latest)
+
+    if args.export_dir:
+        # the base network and the head can be loaded separately using `utils.load_siamese_model`,
+        # which is checked by scoring some test pairs with the loaded models
+        utils.export_siamese_model(model, args.export_dir)
+        pair_indices = te_pair_indices[:32]
+        difference = utils.check_siamese_export(model, args.export_dir, x_test[pair_indices[:, 0]],
+                                                x_test[pair_indices[:, 1]])
+        print('Max. difference of the exported model scores: {:.6f}'.format(difference))
+
+    # compute final accuracy on training and test sets
+    tr_eval_sequence = utils.PairSequence(x_train, tr_pair_indices, tr_y, args.batch_size)
+    tr_pred = model.predict_generator(tr_eval_sequence)
+    te_pred = model.predict_generator(te_sequence)
+
+    if args.model == 'simple_head':
+        tr_acc = compute_accuracy(tr_y, tr_pred)
+        te_acc = compute_accuracy(te_y, te_pred)
+    else:
+        tr_scores = model.evaluate_generator(tr_eval_sequence)
+        tr_acc = tr_scores[1]
+        te_scores = model.evaluate_generator(te_sequence)
+        te_acc = te_scores[1]
+
+    print('>>> Accuracy on training set: {:.2f}%'.format(tr_acc * 100))
+    print('>>> Accuracy on test set:     {:.2f}%'.format(te_acc * 100))
+
+    if args.embedding_store_dir:
+        report_quantized_accuracy(model.get_layer('base_network'), x_test, te_pair_indices, te_y,
+                                  args.embedding_store_dir)
+
+    # plot first 20 examples
+    image_pairs = utils.gather_pairs(x_test, te_pair_indices[:20])
+    labels = te_y[:20]
+    predictions = te_pred[:20]
+
+    plot_examples_separated(image_pairs, labels, predictions)
+
+    # confusion statistics, threshold sweep and hardest errors
+    report = evaluation.evaluate(te_y, te_pred, DISTANCE_THRESHOLD, is_distance=args.model == 'simple_head')
+    evaluation.print_report(report)
+
+    # plot the 10 hardest FPs
+    if len(report['false_positives']) > 0:
+        indices = report['false_positives']
+        plot_examples(utils.gather_pairs(x_test, te_pair_indices[indices]), te_pred[indices])
+
+    # plot the 10 hardest FNs
+    if len(report['false_negatives']) > 0:
+        indices = report['false_negatives']
+        plot_examples(utils.gather_pairs(x_test, te_pair_indices[indices]), te_pred[indices])
+
+    # classify (using minimum distance)
+    print('Classifying test set...')
+    if args.classification == 'cached':
+        min_acc, median_acc, mean_acc = classify_cached(model, x_train, tr_digit_indices, x_test, y_test,
+                                                        simple_head=args.model == 'simple_head')
+    else:
+        min_acc, median_acc, mean_acc = classify_pairwise(model, x_train, tr_digit_indices, x_test, y_test,
+                                                          simple_head=args.model == 'simple_head')
+
+    print('Classification accuracy using MIN:    {}'.format(min_acc))
+    print('Classification accuracy using MEDIAN: {}'.format(median_acc))
+    print('Classification accuracy using MEAN:   {}'.format(mean_acc))
 
 
 if __name__ == '__main__':
@@ -520,10 +693,27 @@ if __name__ == '__main__':
                         help='The network model of the siamese, which mainly differs in the head model used')
     parser.add_argument('--base_network', choices=['fcn', 'cnn', 'nn'], type=str, default='cnn',
                         help='The base network model used in the siamese')
+    parser.add_argument('--classification', choices=['cached', 'pairwise'], type=str, default='cached',
+                        help='Whether to classify the test set using cached embeddings of the base network, ' +
+                             'or by running the full siamese model on each (support image, test image) pair')
+    parser.add_argument('--input_pipeline', choices=['sequence', 'dataset'], type=str, default='sequence',
+                        help='Whether to train on the fixed pairs, or on pairs that are streamed by a tf.data ' +
+                             'pipeline with fresh negative pairs for each epoch')
+    parser.add_argument('--training', choices=['pairs', 'batch_all', 'batch_hard'], type=str, default='pairs',
+                        help='Whether to train on explicit pairs, or on the distance matrix of each batch ' +
+                             'using all valid pairs (contrastive loss) or the hardest ones (triplet loss), ' +
+                             'which requires the simple head model')
+    parser.add_argument('--export_dir', type=str, default=None,
+                        help='If set, the trained base network and head are exported to this directory')
+    parser.add_argument('--embedding_store_dir', type=str, default=None,
+                        help='If set, the test set embeddings are stored quantized in this directory, and the ' +
+                             'accuracy deltas against float32 are reported (simple head model only)')
     parser.add_argument('--early_stopping', type=bool, default=True,
                         help='Whether to use early stopping or not')
     parser.add_argument('--oversample', type=int, default=2,
                         help='Oversampling factor, that indicates the number of time the identical pair ' +
                              'of a positive-label is added, in order to get more different negative-label pairs')
     args = parser.parse_args()
+    if args.embedding_store_dir and args.model != 'simple_head':
+        parser.error('--embedding_store_dir requires --model simple_head')
     main(args)
@@ -0,0 +1,140 @@
+import numpy as np
+
+import one_shot_learning.keras.utils as utils
+
+
+def _square_distances(x, y, y_square_norms=None):
+    if y_square_norms is None:
+        y_square_norms = np.sum(np.square(y), axis=1)
+    return np.sum(np.square(x), axis=1)[:, np.newaxis] + y_square_norms[np.newaxis, :] - 2 * np.dot(x, y.T)
+
+
+def _kmeans(x, num_clusters, num_iterations=20):
+    centroids = x[np.random.choice(len(x), num_clusters, replace=False)]
+    for _ in range(num_iterations):
+        assignments = np.argmin(_square_distances(x, centroids), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        # empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    assignments = np.argmin(_square_distances(x, centroids), axis=1)
+    return centroids, assignments
+
+
+class SupportIndex(object):
+    """
+    Index over the embeddings of a support set, which are computed once by the base network of a siamese model.
+
+    By default, each query is compared to every support example (exact brute-force search using batched matrix
+    multiplications). With num_lists > 1, the class prototypes (mean embedding of each class) are clustered by
+    a coarse quantizer into an inverted file of lists, and each query is only compared to the support examples
+    of the classes in its `num_probes` nearest lists. Classes in lists that were not probed get a score of inf.
+    """
+    def __init__(self, embeddings, labels, num_lists=1, num_probes=1, max_distances=2 ** 24):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.classes, example_classes = np.unique(np.ravel(labels), return_inverse=True)
+        self.max_distances = max_distances  # number of distances that are computed at once
+
+        num_classes = len(self.classes)
+        counts = np.bincount(example_classes, minlength=num_classes)
+        sums = np.zeros((num_classes, self.embeddings.shape[1]), dtype=np.float32)
+        np.add.at(sums, example_classes, self.embeddings)
+        self.prototypes = sums / counts[:, np.newaxis]
+
+        # coarse quantizer, which assigns whole classes to the lists
+        num_lists = min(num_lists, num_classes)
+        if num_lists > 1:
+            self.centroids, class_lists = _kmeans(self.prototypes, num_lists)
+        else:
+            self.centroids = np.mean(self.prototypes, axis=0, keepdims=True)
+            class_lists = np.zeros(num_classes, dtype=np.int64)
+        self.num_probes = min(num_probes, num_lists)
+
+        # the examples of each class, padded to a matrix (-1 marks padding)
+        order = np.argsort(example_classes, kind='mergesort')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        positions = np.arange(np.max(counts))
+        class_examples = np.where(positions[np.newaxis, :] < counts[:, np.newaxis],
+                                  order[np.minimum(starts[:, np.newaxis] + positions[np.newaxis, :], len(order) - 1)],
+                                  -1)
+
+        self.lists = []
+        for l in range(num_lists):
+            list_classes = np.where(class_lists == l)[0]
+            padded = class_examples[list_classes, :np.max(counts[list_classes], initial=0)]
+            valid = padded >= 0
+            example_indices = padded[valid]
+            # positions of the padded examples within the examples of the list
+            local = np.full(padded.shape, -1, dtype=np.int64)
+            local[valid] = np.arange(len(example_indices))
+            list_embeddings = self.embeddings[example_indices]
+            self.lists.append((list_classes, example_indices, local,
+                               list_embeddings, np.sum(np.square(list_embeddings), axis=1)))
+
+    def _probe(self, queries):
+        if len(self.lists) == 1:
+            return np.zeros((len(queries), 1), dtype=np.int64)
+        distances = _square_distances(queries, self.centroids)
+        return np.argpartition(distances, self.num_probes - 1, axis=1)[:, :self.num_probes]
+
+    def _batches(self, queries):
+        """Yields the list, the indices of the queries probing it (in batches) and their distances
+        to the examples of the list.
+        """
+        probes = self._probe(queries)
+        for l, (_, example_indices, _, list_embeddings, square_norms) in enumerate(self.lists):
+            if len(example_indices) == 0:
+                continue
+            query_indices = np.where(np.any(probes == l, axis=1))[0]
+            batch_size = max(1, self.max_distances // len(example_indices))
+            for start in range(0, len(query_indices), batch_size):
+                batch = query_indices[start:start + batch_size]
+                sum_square = _square_distances(queries[batch], list_embeddings, square_norms)
+                yield l, batch, np.sqrt(np.maximum(sum_square, utils.EPSILON))
+
+    def search(self, queries, k=1):
+        """Returns the distances and the indices of the k nearest support examples of each query,
+        sorted by distance. Missing neighbors have a distance of inf and an index of -1.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for l, batch, distances in self._batches(queries):
+            example_indices = self.lists[l][1]
+            candidate_distances = np.concatenate([best_distances[batch], distances], axis=1)
+            candidate_indices = np.concatenate([best_indices[batch],
+                                                np.broadcast_to(example_indices, distances.shape)], axis=1)
+            top = np.argpartition(candidate_distances, k - 1, axis=1)[:, :k]
+            best_distances[batch] = np.take_along_axis(candidate_distances, top, axis=1)
+            best_indices[batch] = np.take_along_axis(candidate_indices, top, axis=1)
+
+        order = np.argsort(best_distances, axis=1)
+        return np.take_along_axis(best_distances, order, axis=1), np.take_along_axis(best_indices, order, axis=1)
+
+    def class_scores(self, queries):
+        """Returns the MIN, MEDIAN and MEAN distance of each query to the support examples of each class,
+        as (queries x classes) arrays, whose columns correspond to `self.classes`.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        shape = (len(queries), len(self.classes))
+        min_scores = np.full(shape, np.inf, dtype=np.float32)
+        median_scores = np.full(shape, np.inf, dtype=np.float32)
+        mean_scores = np.full(shape, np.inf, dtype=np.float32)
+        for l, batch, distances in self._batches(queries):
+            list_classes, _, local = self.lists[l][:3]
+            # (queries, classes of the list, examples per class), where padding is NaN
+            grouped = np.where(local >= 0, distances[:, local], np.nan)
+            rows, cols = np.ix_(batch, list_classes)
+            min_scores[rows, cols] = np.nanmin(grouped, axis=2)
+            median_scores[rows, cols] = np.nanmedian(grouped, axis=2)
+            mean_scores[rows, cols] = np.nanmean(grouped, axis=2)
+        return min_scores, median_scores, mean_scores
+
+    def nearest_prototypes(self, queries):
+        """Returns the class of the nearest class prototype of each query.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        distances = _square_distances(queries, self.prototypes)
+        return self.classes[np.argmin(distances, axis=1)]
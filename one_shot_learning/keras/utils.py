@@ -0,0 +1,247 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+# the epsilon of the euclidean distance of the siamese models, which the cached embedding distances also use
+EPSILON = tf.keras.backend.epsilon()
+
+
+def create_pair_indices(digit_indices, oversample_factor=1):
+    """Positive and negative pair creation.
+    Alternates between positive and negative pairs. Instead of copying the images, this only returns
+    an (N x 2) int32 array of indices into the image array, as well as the labels of the pairs.
+    """
+    num_classes = len(digit_indices)
+    lengths = np.array([len(digit_indices[d]) for d in range(num_classes)])
+    n = np.min(lengths)
+
+    # pad the per class indices to a matrix, so that we can gather from it
+    class_indices = np.zeros((num_classes, np.max(lengths)), dtype=np.int32)
+    for d in range(num_classes):
+        class_indices[d, :lengths[d]] = digit_indices[d]
+
+    # all (i, j) combinations with i < j of the first n examples, for each class
+    i, j = np.triu_indices(n, k=1)
+    anchors = np.tile(class_indices[:, i].ravel(), oversample_factor)
+    positives = np.tile(class_indices[:, j].ravel(), oversample_factor)
+    classes = np.tile(np.repeat(np.arange(num_classes), len(i)), oversample_factor)
+
+    # pair each anchor with a random example of a random other class
+    negative_classes = (classes + np.random.randint(1, num_classes, size=classes.shape)) % num_classes
+    negative_positions = np.random.randint(0, lengths[negative_classes])
+    negatives = class_indices[negative_classes, negative_positions]
+
+    pair_indices = np.empty((2 * len(anchors), 2), dtype=np.int32)
+    pair_indices[0::2, 0] = anchors
+    pair_indices[0::2, 1] = positives
+    pair_indices[1::2, 0] = anchors
+    pair_indices[1::2, 1] = negatives
+    labels = np.tile([1, 0], len(anchors))
+    return pair_indices, labels
+
+
+def gather_pairs(x, pair_indices):
+    """Gathers the images of the given index pairs into an (N x 2 x ...) array.
+    """
+    return np.stack([x[pair_indices[:, 0]], x[pair_indices[:, 1]]], axis=1)
+
+
+def create_data_variable(array):
+    """Holds the array in a local variable, which is initialized from a placeholder in the keras session,
+    so that the data is not embedded into the graph (and its 2GB GraphDef limit) like a constant would be.
+    """
+    placeholder = tf.placeholder(array.dtype, array.shape)
+    variable = tf.Variable(placeholder, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                           use_resource=True)
+    tf.keras.backend.get_session().run(variable.initializer, feed_dict={placeholder: array})
+    return variable
+
+
+def create_pair_dataset(x, digit_indices, batch_size, oversample_factor=1):
+    """Streams positive and negative pairs, which are drawn on the fly from the per class indices.
+    An epoch uses each positive pair of the first n examples of a class `oversample_factor` times,
+    like `create_pair_indices`, but pairs each of them with a freshly drawn negative pair.
+    Returns the dataset and the number of steps per epoch.
+    """
+    num_classes = len(digit_indices)
+    lengths = np.array([len(digit_indices[d]) for d in range(num_classes)], dtype=np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int32)
+    n = np.min(lengths)
+
+    # only the images of the per class indices are kept, grouped by class
+    images = create_data_variable(x[np.concatenate(digit_indices)])
+
+    i, j = np.triu_indices(n, k=1)
+    classes = np.repeat(np.arange(num_classes, dtype=np.int32), len(i))
+    anchors = offsets[classes] + np.tile(i, num_classes).astype(np.int32)
+    positives = offsets[classes] + np.tile(j, num_classes).astype(np.int32)
+
+    def to_pairs(anchor, positive, d):
+        num = tf.shape(anchor)[0]
+        negative_class = (d + tf.random_uniform([num], 1, num_classes, dtype=tf.int32)) % num_classes
+        negative_length = tf.gather(lengths, negative_class)
+        negative_position = tf.minimum(tf.to_int32(tf.random_uniform([num]) * tf.to_float(negative_length)),
+                                       negative_length - 1)
+        negative = tf.gather(offsets, negative_class) + negative_position
+
+        # alternate between positive and negative pairs
+        indices_a = tf.reshape(tf.stack([anchor, anchor], axis=1), [-1])
+        indices_b = tf.reshape(tf.stack([positive, negative], axis=1), [-1])
+        labels = tf.reshape(tf.tile([[1.0, 0.0]], [num, 1]), [-1])
+        return (tf.gather(images, indices_a), tf.gather(images, indices_b)), labels
+
+    # each batch consists of half positive and half negative pairs
+    half_batch_size = max(1, batch_size // 2)
+    dataset = tf.data.Dataset.from_tensor_slices((anchors, positives, classes))
+    dataset = dataset.shuffle(len(anchors), reshuffle_each_iteration=True).repeat()
+    dataset = dataset.batch(half_batch_size)
+    dataset = dataset.map(to_pairs, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    steps_per_epoch = int(np.ceil(len(anchors) * oversample_factor / float(half_batch_size)))
+    return dataset, steps_per_epoch
+
+
+def create_pair_index_dataset(x, pair_indices, labels, batch_size):
+    """Streams the fixed pairs of `create_pair_indices`, e.g. for validation.
+    Returns the dataset and the number of steps to go once over all pairs.
+    """
+    # only the images that are used by any pair are kept
+    unique_indices, inverse = np.unique(pair_indices, return_inverse=True)
+    images = create_data_variable(x[unique_indices])
+    pair_indices = inverse.reshape(-1, 2).astype(np.int32)
+
+    def to_pairs(batch_indices, batch_labels):
+        return (tf.gather(images, batch_indices[:, 0]), tf.gather(images, batch_indices[:, 1])), batch_labels
+
+    dataset = tf.data.Dataset.from_tensor_slices((pair_indices, labels.astype(np.float32)))
+    dataset = dataset.batch(batch_size).repeat()
+    dataset = dataset.map(to_pairs, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    steps = int(np.ceil(len(pair_indices) / float(batch_size)))
+    return dataset, steps
+
+
+def export_siamese_model(model, export_dir):
+    """Saves the base network (embedding tower) and the head of a siamese model as separate models,
+    so that the tower can be served on its own and the head can score precomputed embeddings.
+    """
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    model.get_layer('base_network').save(os.path.join(export_dir, 'base_network.h5'), include_optimizer=False)
+    model.get_layer('head').save(os.path.join(export_dir, 'head.h5'), include_optimizer=False)
+
+
+def load_siamese_model(export_dir, custom_objects=None):
+    """Loads the base network and the head, which were saved by `export_siamese_model`.
+    The Lambda layers of the heads refer to `tf`, which is always passed. Other functions used by
+    the Lambda layers have to be passed as `custom_objects`.
+    """
+    custom_objects = dict({'tf': tf}, **(custom_objects or {}))
+    base_network = tf.keras.models.load_model(os.path.join(export_dir, 'base_network.h5'), compile=False)
+    head = tf.keras.models.load_model(os.path.join(export_dir, 'head.h5'), custom_objects=custom_objects,
+                                      compile=False)
+    return base_network, head
+
+
+def check_siamese_export(model, export_dir, x_a, x_b, custom_objects=None):
+    """Loads the exported base network and head, scores the pairs (x_a[i], x_b[i]) with them and
+    returns the maximum absolute difference to the scores of the full siamese model.
+    """
+    base_network, head = load_siamese_model(export_dir, custom_objects)
+    scores = np.diag(score_all_pairs(base_network, head, x_a, x_b))
+    expected = model.predict([x_a, x_b]).ravel()
+    return np.max(np.abs(scores - expected))
+
+
+def score_embedding_pairs(head, embeddings_a, embeddings_b, batch_size=4096):
+    """Scores all (N x M) pairs of precomputed embeddings with the head of a siamese model.
+    """
+    num_b = len(embeddings_b)
+    scores = np.empty((len(embeddings_a), num_b), dtype=np.float32)
+    # number of rows of embeddings_a, whose pairs are scored with a single predict call
+    chunk_size = max(1, batch_size * 16 // num_b)
+    for start in range(0, len(embeddings_a), chunk_size):
+        chunk = embeddings_a[start:start + chunk_size]
+        pairs_a = np.repeat(chunk, num_b, axis=0)
+        pairs_b = np.tile(embeddings_b, (len(chunk), 1))
+        predictions = head.predict([pairs_a, pairs_b], batch_size=batch_size)
+        scores[start:start + len(chunk)] = predictions.reshape(len(chunk), num_b)
+    return scores
+
+
+def score_all_pairs(base_network, head, x_a, x_b, batch_size=4096):
+    """Scores all (N x M) pairs of images, which costs N + M passes of the base network
+    and N x M passes of the (cheap) head.
+    """
+    embeddings_a = base_network.predict(x_a, batch_size=batch_size)
+    embeddings_b = base_network.predict(x_b, batch_size=batch_size)
+    return score_embedding_pairs(head, embeddings_a, embeddings_b, batch_size)
+
+
+class PairSequence(tf.keras.utils.Sequence):
+    """Feeds image pairs to a siamese model, by gathering the images of each batch only when it is needed.
+    """
+    def __init__(self, x, pair_indices, labels, batch_size, shuffle=False):
+        self.x = x
+        self.pair_indices = pair_indices
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(pair_indices))
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+    def __len__(self):
+        return int(np.ceil(len(self.pair_indices) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch_order = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        batch_indices = self.pair_indices[batch_order]
+        return [self.x[batch_indices[:, 0]], self.x[batch_indices[:, 1]]], self.labels[batch_order]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
+class ClassBatchSequence(tf.keras.utils.Sequence):
+    """Feeds batches of labelled images for in-batch training. Each batch consists of `num_classes_per_batch`
+    random classes with `num_examples_per_class` random examples each, so that every example of the batch has
+    positive as well as negative examples within the batch.
+    """
+    def __init__(self, x, digit_indices, num_classes_per_batch, num_examples_per_class=4):
+        self.x = x
+        self.num_classes = len(digit_indices)
+        self.num_classes_per_batch = min(num_classes_per_batch, self.num_classes)
+        self.num_examples_per_class = num_examples_per_class
+        self.lengths = np.array([len(digit_indices[d]) for d in range(self.num_classes)])
+
+        # pad the per class indices to a matrix, so that we can gather from it
+        self.class_indices = np.zeros((self.num_classes, np.max(self.lengths)), dtype=np.int32)
+        for d in range(self.num_classes):
+            self.class_indices[d, :self.lengths[d]] = digit_indices[d]
+
+        # one epoch sees about as many images as there are per class indices
+        self.steps = int(np.ceil(np.sum(self.lengths) /
+                                 float(self.num_classes_per_batch * self.num_examples_per_class)))
+
+    def __len__(self):
+        return self.steps
+
+    def __getitem__(self, idx):
+        classes = np.random.choice(self.num_classes, self.num_classes_per_batch, replace=False)
+        # the examples of a class are drawn without replacement (random keys, with the padding sorted last),
+        # because a duplicate image would be a positive pair of zero distance
+        lengths = self.lengths[classes][:, np.newaxis]
+        keys = np.random.random((self.num_classes_per_batch, self.class_indices.shape[1]))
+        keys[np.arange(self.class_indices.shape[1]) >= lengths] = np.inf
+        k = min(self.num_examples_per_class, keys.shape[1])
+        positions = np.argpartition(keys, k - 1, axis=1)[:, :k]
+        # classes with fewer examples than needed repeat some of them
+        positions = positions[:, np.arange(self.num_examples_per_class) % k] % lengths
+        indices = self.class_indices[classes[:, np.newaxis], positions].ravel()
+        labels = np.repeat(classes, self.num_examples_per_class).astype(np.float32)
+        return self.x[indices], labels[:, np.newaxis]
@@ -1,29 +1,80 @@
 import argparse
+import multiprocessing
 import random
 import sys
 
 import numpy as np
-import gym
+import scipy.signal
 import tensorflow as tf
 
+from reinforcement_learning.tfgym.cart_pole_sim import BatchedCartPole, CartPoleEnv, TERMINATION_REWARD
+
+try:
+    import gym
+except ImportError:
+    # the numpy simulator (--simulator numpy) does not need gym
+    gym = None
+
 ACTION_LEFT = 0
 ACTION_RIGHT = 1
 
-TERMINATION_REWARD = 200
-TERMINATION_ANGLE = 12.0
-TERMINATION_POSITION = 2.4
+FLIP_SPEED_LIMIT = 0.00125
+NAIVE3_GAP = [1.0, 1.165]
+
+
+class GymEnvs(object):
+    """Steps a list of gym environments with the interface of a BatchedCartPole.
+    """
+    def __init__(self, envs):
+        self.envs = envs
+        self.n_envs = len(envs)
+        self.obs = None
+        self.done = None
+
+    def reset(self):
+        self.obs = np.stack([env.reset() for env in self.envs])
+        self.done = np.zeros(self.n_envs, dtype=bool)
+        return self.obs.copy()
+
+    def step(self, actions):
+        rewards = np.zeros(self.n_envs)
+        for i in np.where(~self.done)[0]:
+            self.obs[i], rewards[i], self.done[i], info = self.envs[i].step(actions[i])
+        return self.obs.copy(), rewards, self.done.copy()
+
+    def __getitem__(self, index):
+        # the sliced batch shares the gym environments
+        return GymEnvs(self.envs[index])
+
+
+def make_batched_envs(env, n_envs):
+    if isinstance(env, CartPoleEnv):
+        return BatchedCartPole(n_envs)
+    return GymEnvs([gym.make(env.spec.id) for _ in range(n_envs)])
+
+
+def flip_actions(actions, pole_angle, pole_velo):
+    flip = (np.abs(pole_angle) < 3.0) & \
+        (((pole_angle < 0) & (pole_velo > FLIP_SPEED_LIMIT)) | ((pole_angle > 0) & (pole_velo < FLIP_SPEED_LIMIT)))
+    return np.where(flip, 1 - actions, actions)
 
 
 class RandomPolicy(object):
     def predict(self, obs: np.ndarray):
         return random.randint(0, 1)
 
+    def predict_batch(self, obs: np.ndarray):
+        return np.random.randint(0, 2, size=len(obs))
+
 
 class Naive1Policy(object):
     def predict(self, obs: np.ndarray):
         angle = obs[2]
         return ACTION_LEFT if angle < 0 else ACTION_RIGHT
 
+    def predict_batch(self, obs: np.ndarray):
+        return np.where(obs[:, 2] < 0, ACTION_LEFT, ACTION_RIGHT)
+
 
 class Naive2Policy(object):
     def predict(self, obs: np.ndarray):
@@ -34,15 +85,18 @@ class Naive2Policy(object):
         action = ACTION_LEFT if pole_angle < 0 else ACTION_RIGHT
 
         flip_action = False
-        flip_speed_limit = 0.00125
         if abs(pole_angle) < 3.0:
-            if pole_angle < 0 and pole_velo > flip_speed_limit:
+            if pole_angle < 0 and pole_velo > FLIP_SPEED_LIMIT:
                 flip_action = True
-            elif pole_angle > 0 and pole_velo < flip_speed_limit:
+            elif pole_angle > 0 and pole_velo < FLIP_SPEED_LIMIT:
                 flip_action = True
 
         return 1 - action if flip_action else action
 
+    def predict_batch(self, obs: np.ndarray):
+        actions = np.where(obs[:, 2] < 0, ACTION_LEFT, ACTION_RIGHT)
+        return flip_actions(actions, obs[:, 2], obs[:, 3])
+
 
 class Naive3Policy(object):
     def predict(self, obs: np.ndarray):
@@ -54,20 +108,144 @@ class Naive3Policy(object):
         action = ACTION_LEFT if pole_angle < 0 else ACTION_RIGHT
 
         flip_action = False
-        flip_speed_limit = 0.00125
-        gap = [1.0, 1.165]
+        gap = NAIVE3_GAP
 
         if -gap[1] < cart_pos < -gap[0] or gap[0] < cart_pos < gap[1]:
             return action
 
         if abs(pole_angle) < 3.0:
-            if pole_angle < 0 and pole_velo > flip_speed_limit:
+            if pole_angle < 0 and pole_velo > FLIP_SPEED_LIMIT:
                 flip_action = True
-            elif pole_angle > 0 and pole_velo < flip_speed_limit:
+            elif pole_angle > 0 and pole_velo < FLIP_SPEED_LIMIT:
                 flip_action = True
 
         return 1 - action if flip_action else action
 
+    def predict_batch(self, obs: np.ndarray):
+        cart_pos = obs[:, 0]
+        gap = NAIVE3_GAP
+        actions = np.where(obs[:, 2] < 0, ACTION_LEFT, ACTION_RIGHT)
+        in_gap = ((-gap[1] < cart_pos) & (cart_pos < -gap[0])) | ((gap[0] < cart_pos) & (cart_pos < gap[1]))
+        return np.where(in_gap, actions, flip_actions(actions, obs[:, 2], obs[:, 3]))
+
+
+def discounted_returns(rewards, discount_rate, lengths=None, normalize=True):
+    """Computes the discounted returns of all episodes at once, for a padded (episodes x steps) rewards matrix,
+    or for a flat rewards array of consecutive episodes. `lengths` are the numbers of steps of the episodes
+    (required for flat rewards, padding is ignored for padded rewards). The returns are normalized to
+    zero mean and unit variance over all (valid) steps, unless `normalize` is False.
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    # reverse linear filter: G[t] = r[t] + discount_rate * G[t + 1]
+    returns = scipy.signal.lfilter([1.0], [1.0, -discount_rate], rewards[..., ::-1], axis=-1)[..., ::-1]
+
+    if rewards.ndim == 2:
+        # padding (zeros, after the last step) does not add to the returns of the valid steps
+        if lengths is None:
+            valid = np.ones(rewards.shape, dtype=bool)
+        else:
+            valid = np.arange(rewards.shape[1])[np.newaxis, :] < np.asarray(lengths)[:, np.newaxis]
+    else:
+        # the filter runs across the episode boundaries, so each step contains the discounted return of
+        # the first step of the next episode, which is subtracted
+        ends = np.cumsum(lengths)
+        steps = np.arange(len(rewards))
+        next_starts = np.repeat(ends, lengths)
+        leaked = next_starts < len(rewards)
+        distances = next_starts[leaked] - steps[leaked]
+        returns[leaked] -= discount_rate ** distances * returns[next_starts[leaked]]
+        valid = np.ones(rewards.shape, dtype=bool)
+
+    if normalize:
+        returns = np.where(valid, (returns - returns[valid].mean()) / returns[valid].std(), 0.0)
+    return returns
+
+
+def elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+
+class SharedWeightsPolicy(object):
+    """NumPy copy of the forward pass of a PolicyGradientsNet, whose weights live in shared memory.
+    Rollout worker processes inherit the shared memory, so they act with the weights of the latest update
+    as soon as `set_weights` is called in the main process.
+    """
+    def __init__(self, shapes):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.buffer = multiprocessing.RawArray('f', int(sum(np.prod(shape) for shape in self.shapes)))
+
+    def set_weights(self, weights):
+        np.frombuffer(self.buffer, dtype=np.float32)[:] = np.concatenate([np.ravel(w) for w in weights])
+
+    def get_weights(self):
+        flat = np.frombuffer(self.buffer, dtype=np.float32)
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+        return [flat[start:end].reshape(shape) for start, end, shape in zip(offsets[:-1], offsets[1:], self.shapes)]
+
+    def predict_batch(self, obs):
+        kernel1, bias1, kernel2, bias2, kernel3, bias3 = self.get_weights()
+        hidden1 = elu(np.dot(obs, kernel1) + bias1)
+        hidden2 = elu(np.dot(hidden1, kernel2) + bias2)
+        logits = np.dot(hidden2, kernel3) + bias3
+        # the sigmoid output is the probability of moving left
+        p_left = 1.0 / (1.0 + np.exp(-logits[:, 0]))
+        return np.where(np.random.random(len(obs)) < p_left, ACTION_LEFT, ACTION_RIGHT)
+
+    def predict(self, obs):
+        return self.predict_batch(obs.reshape(1, -1))[0]
+
+
+_rollout_worker = {}
+
+
+def _init_rollout_worker(policy, simulator):
+    _rollout_worker['policy'] = policy
+    _rollout_worker['env'] = CartPoleEnv() if simulator == 'numpy' else gym.make('CartPole-v0')
+
+
+def _play_episode(args):
+    n_max_steps, seed = args
+    # the forked workers would otherwise share the state of the random generators
+    np.random.seed(seed)
+    random.seed(seed)
+    policy = _rollout_worker['policy']
+    env = _rollout_worker['env']
+
+    obs = env.reset()
+    observations = np.zeros((n_max_steps, len(obs)), dtype=np.float32)
+    actions = np.zeros(n_max_steps, dtype=np.int64)
+    rewards = np.zeros(n_max_steps, dtype=np.float32)
+    for step in range(n_max_steps):
+        observations[step] = obs
+        actions[step] = policy.predict(obs)
+        obs, rewards[step], done, info = env.step(actions[step])
+        if done:
+            break
+    return observations[:step + 1], actions[:step + 1], rewards[:step + 1]
+
+
+class RolloutWorkerPool(object):
+    """Pool of processes, which play episodes with their own environment and a copy of the policy,
+    and return the observations, actions and rewards of each episode as NumPy arrays.
+    """
+    def __init__(self, policy, simulator, n_workers=None):
+        self.policy = policy
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.n_workers, initializer=_init_rollout_worker,
+                                         initargs=(policy, simulator))
+
+    def set_weights(self, weights):
+        self.policy.set_weights(weights)
+
+    def rollout(self, n_episodes, n_max_steps):
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=n_episodes)
+        chunksize = max(1, n_episodes // (4 * self.n_workers))
+        return self.pool.map(_play_episode, [(n_max_steps, int(seed)) for seed in seeds], chunksize=chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
 
 class PolicyGradientsNet(object):
     def __init__(self, n_inputs, n_hidden):
@@ -82,6 +260,9 @@ class PolicyGradientsNet(object):
         self.gradients = None
         self.gradient_phs = None
         self.train_op = None
+        self.actions_ph = None
+        self.advantages_ph = None
+        self.batch_train_op = None
         self.sess = tf.InteractiveSession()
         self.saver = None
         pass
@@ -121,8 +302,22 @@ class PolicyGradientsNet(object):
             grads_and_vars_feed.append((gradient_ph, var))
         self.train_op = optimizer.apply_gradients(grads_and_vars_feed)
 
-    def train(self, env: gym.Env, n_iterations, discount_rate, n_episodes_per_update, n_max_steps,
-              save_iterations=50):
+        # batched update: the mean of the gradients of the recorded steps, weighted by their normalized
+        # discounted rewards, is the gradient of the mean of the weighted costs
+        self.actions_ph = tf.placeholder(tf.int64, shape=[None, 1])
+        self.advantages_ph = tf.placeholder(tf.float32, shape=[None])
+        recorded_cost = tf.nn.sigmoid_cross_entropy_with_logits(labels=1.0 - tf.to_float(self.actions_ph),
+                                                                 logits=self.logits)
+        weighted_cost = tf.reduce_mean(tf.expand_dims(self.advantages_ph, 1) * recorded_cost)
+        self.batch_train_op = optimizer.minimize(weighted_cost)
+
+    def train(self, env: 'gym.Env', n_iterations, discount_rate, n_episodes_per_update, n_max_steps,
+              save_iterations=50, n_envs=0, batched_update=False, rollout_pool=None):
+        if n_envs > 0 or batched_update or rollout_pool is not None:
+            self._train_batched(env, n_iterations, discount_rate, n_episodes_per_update, n_max_steps,
+                                save_iterations, n_envs, rollout_pool)
+            return
+
         for iteration in range(n_iterations):
             print(iteration)
             all_rewards = []
@@ -159,6 +354,97 @@ class PolicyGradientsNet(object):
             if iteration % save_iterations == 0:
                 self.saver.save(self.sess, './tmp/cartpole_agent.ckpt')
 
+    def _train_batched(self, env: 'gym.Env', n_iterations, discount_rate, n_episodes_per_update, n_max_steps,
+                       save_iterations, n_envs, rollout_pool=None):
+        """Plays the episodes one by one, in `n_envs` environments in lock-step or in the worker processes of
+        the rollout pool, recording only the observations, actions and rewards, and updates the policy with
+        a single batched run per iteration.
+        """
+        envs = make_batched_envs(env, n_envs) if n_envs > 0 and rollout_pool is None else None
+        for iteration in range(n_iterations):
+            print(iteration)
+            episodes = []
+            if rollout_pool is not None:
+                # the workers act with the weights of the latest update
+                rollout_pool.set_weights(self.get_weights())
+                episodes = rollout_pool.rollout(n_episodes_per_update, n_max_steps)
+            while len(episodes) < n_episodes_per_update:
+                if envs is None:
+                    episodes.append(self._rollout(env, n_max_steps))
+                else:
+                    # only as many episodes are played, as are missing for the update
+                    episodes.extend(self._rollout_vectorized(envs[:n_episodes_per_update - len(episodes)],
+                                                             n_max_steps))
+
+            self._batched_update(episodes, discount_rate)
+            if iteration % save_iterations == 0:
+                self.saver.save(self.sess, './tmp/cartpole_agent.ckpt')
+
+    def _batched_update(self, episodes, discount_rate):
+        """Computes the advantage-weighted gradient of all steps of the episodes and applies it in one run.
+        """
+        advantages = discounted_returns(np.concatenate([rewards for _, _, rewards in episodes]), discount_rate,
+                                        [len(rewards) for _, _, rewards in episodes])
+        self.sess.run(self.batch_train_op, feed_dict={
+            self.x_ph: np.concatenate([observations for observations, _, _ in episodes]),
+            self.actions_ph: np.concatenate([actions for _, actions, _ in episodes]).reshape(-1, 1),
+            self.advantages_ph: advantages,
+        })
+
+    def _rollout(self, env: 'gym.Env', n_max_steps):
+        """Plays one episode and returns its observations, actions and rewards.
+        """
+        observations = np.zeros((n_max_steps, self.n_inputs), dtype=np.float32)
+        actions = np.zeros(n_max_steps, dtype=np.int64)
+        rewards = np.zeros(n_max_steps, dtype=np.float32)
+
+        obs = env.reset()
+        for step in range(n_max_steps):
+            action_val = self.sess.run(self.action, feed_dict={self.x_ph: obs.reshape(1, self.n_inputs)})
+            observations[step] = obs
+            actions[step] = action_val[0][0]
+            obs, rewards[step], done, info = env.step(actions[step])
+            if done:
+                break
+        return observations[:step + 1], actions[:step + 1], rewards[:step + 1]
+
+    def _rollout_vectorized(self, envs, n_max_steps):
+        """Plays one episode in each environment in lock-step, evaluating the policy on the observations of
+        all environments, whose episodes are not done yet, with a single run per step.
+        Returns the observations, actions and rewards of each episode.
+        """
+        n = envs.n_envs
+        obs = envs.reset()
+        active = np.ones(n, dtype=bool)
+        lengths = np.zeros(n, dtype=np.int64)
+        observations = np.zeros((n_max_steps, n, self.n_inputs), dtype=np.float32)
+        actions = np.zeros((n_max_steps, n), dtype=np.int64)
+        rewards = np.zeros((n_max_steps, n), dtype=np.float32)
+
+        for step in range(n_max_steps):
+            indices = np.where(active)[0]
+            if len(indices) == 0:
+                break
+            action_vals = self.sess.run(self.action, feed_dict={self.x_ph: obs[indices]})[:, 0]
+            observations[step, indices] = obs[indices]
+            actions[step, indices] = action_vals
+            lengths[indices] += 1
+            obs, step_rewards, done = envs.step(actions[step])
+            rewards[step, indices] = step_rewards[indices]
+            # finished episodes are masked out of the following steps
+            active = ~done
+
+        return [(observations[:lengths[i], i], actions[:lengths[i], i], rewards[:lengths[i], i]) for i in range(n)]
+
+    def get_weights(self):
+        return self.sess.run(tf.trainable_variables())
+
+    @staticmethod
+    def weight_shapes(n_inputs, n_hidden, n_outputs=1):
+        """Returns the shapes of the kernels and biases of the dense layers, without building the graph.
+        """
+        return [[n_inputs, n_hidden], [n_hidden], [n_hidden, n_hidden], [n_hidden], [n_hidden, n_outputs], [n_outputs]]
+
     def restore(self):
         self.saver = tf.train.Saver()
         latest_cp_path = tf.train.latest_checkpoint('./tmp/')
@@ -169,24 +455,11 @@ class PolicyGradientsNet(object):
             self.saver.restore(self.sess, latest_cp_path)
             print('Restored checkpoint: ' + latest_cp_path)
 
-    @staticmethod
-    def _discount_rewards(rewards, discount_rate):
-        discounted_rewards = np.empty(len(rewards))
-        cumultative_rewards = 0
-        for step in reversed(range(len(rewards))):
-            cumultative_rewards = rewards[step] + cumultative_rewards * discount_rate
-            discounted_rewards[step] = cumultative_rewards
-        return discounted_rewards
-
     @staticmethod
     def _discount_and_normalize_rewards(all_rewards, discount_rate):
-        all_discounted_rewards = [PolicyGradientsNet._discount_rewards(rewards, discount_rate)
-                                  for rewards in all_rewards]
-        flat_rewards = np.concatenate(all_discounted_rewards)
-        rewards_mean = flat_rewards.mean()
-        rewards_std = flat_rewards.std()
-        return [(discounted_rewards - rewards_mean) / rewards_std
-                for discounted_rewards in all_discounted_rewards]
+        lengths = [len(rewards) for rewards in all_rewards]
+        returns = discounted_returns(np.concatenate(all_rewards), discount_rate, lengths)
+        return np.split(returns, np.cumsum(lengths)[:-1])
 
     def predict(self, obs):
         action_val = self.sess.run(
@@ -194,11 +467,64 @@ class PolicyGradientsNet(object):
             feed_dict={self.x_ph: obs.reshape(1, self.n_inputs)})
         return action_val[0][0]
 
+    def predict_batch(self, obs):
+        return self.sess.run(self.action, feed_dict={self.x_ph: obs})[:, 0]
+
+
+def evaluate(policy, env, n_episodes, n_max_steps, render):
+    totals = []
+    for episode in range(n_episodes):
+        episode_reward = 0
+        obs = env.reset()
+
+        for step in range(n_max_steps):
+            action = policy.predict(obs)
+
+            obs, reward, done, info = env.step(action)
+            episode_reward += reward
+
+            if render:
+                env.render()
+
+            if done:
+                break
+
+        totals.append(episode_reward)
+    return totals
+
+
+def evaluate_batched(policy, n_episodes, n_max_steps):
+    """Plays all episodes at once in the numpy simulator and returns their total rewards.
+    """
+    envs = BatchedCartPole(n_episodes)
+    obs = envs.reset()
+    totals = np.zeros(n_episodes)
+    for step in range(n_max_steps):
+        obs, rewards, done = envs.step(policy.predict_batch(obs))
+        totals += rewards
+        if np.all(done):
+            break
+    return totals
+
+
+def evaluate_parallel(rollout_pool, n_episodes, n_max_steps):
+    """Plays the episodes in the worker processes of the pool and returns their total rewards.
+    """
+    return [np.sum(rewards) for _, _, rewards in rollout_pool.rollout(n_episodes, n_max_steps)]
+
 
 def main(_):
     # https://github.com/openai/gym/wiki/CartPole-v0
-    env = gym.make('CartPole-v0')
+    if FLAGS.simulator == 'numpy':
+        env = CartPoleEnv()
+        n_inputs = 4
+    else:
+        if gym is None:
+            raise Exception('gym is not installed, use --simulator numpy instead!')
+        env = gym.make('CartPole-v0')
+        n_inputs = env.observation_space.shape[0]
 
+    n_hidden = 8
     if FLAGS.policy == 'naive1':
         policy = Naive1Policy()
     elif FLAGS.policy == 'naive2':
@@ -206,33 +532,40 @@ def main(_):
     elif FLAGS.policy == 'naive3':
         policy = Naive3Policy()
     elif FLAGS.policy == 'pg':
-        policy = PolicyGradientsNet(env.observation_space.shape[0], n_hidden=8)
-        policy.build(learning_rate=0.01)
-        policy.restore()
-        policy.train(env, n_iterations=FLAGS.train_steps, discount_rate=0.95, n_episodes_per_update=10, n_max_steps=FLAGS.max_steps)
+        policy = None
     else:
         policy = RandomPolicy()
 
-    print('Starting evaluation...')
-
-    totals = []
-    for episode in range(FLAGS.episodes):
-        episode_reward = 0
-        obs = env.reset()
-
-        for step in range(FLAGS.max_steps):
-            action = policy.predict(obs)
+    # the workers are forked before the policy gradients net creates its session, because forking
+    # a process, which already runs the thread pools of TF, is not safe
+    rollout_pool = None
+    if FLAGS.workers > 0:
+        if policy is None:
+            rollout_pool = RolloutWorkerPool(SharedWeightsPolicy(PolicyGradientsNet.weight_shapes(n_inputs, n_hidden)),
+                                             FLAGS.simulator, FLAGS.workers)
+        else:
+            rollout_pool = RolloutWorkerPool(policy, FLAGS.simulator, FLAGS.workers)
 
-            obs, reward, done, info = env.step(action)
-            episode_reward += reward
+    if policy is None:
+        policy = PolicyGradientsNet(n_inputs, n_hidden=n_hidden)
+        policy.build(learning_rate=0.01)
+        policy.restore()
 
-            if FLAGS.render:
-                env.render()
+    if isinstance(policy, PolicyGradientsNet):
+        policy.train(env, n_iterations=FLAGS.train_steps, discount_rate=0.95, n_episodes_per_update=FLAGS.episodes_per_update, n_max_steps=FLAGS.max_steps,
+                     n_envs=FLAGS.n_envs, batched_update=FLAGS.batched_update, rollout_pool=rollout_pool)
 
-            if done:
-                break
+    print('Starting evaluation...')
 
-        totals.append(episode_reward)
+    if rollout_pool is not None:
+        if isinstance(policy, PolicyGradientsNet):
+            rollout_pool.set_weights(policy.get_weights())
+        totals = evaluate_parallel(rollout_pool, FLAGS.episodes, FLAGS.max_steps)
+        rollout_pool.close()
+    elif FLAGS.simulator == 'numpy':
+        totals = evaluate_batched(policy, FLAGS.episodes, FLAGS.max_steps)
+    else:
+        totals = evaluate(policy, env, FLAGS.episodes, FLAGS.max_steps, FLAGS.render)
 
     totals = np.asarray(totals)
     print('Min: {}'.format(np.min(totals)))
@@ -252,7 +585,18 @@ if __name__ == '__main__':
                         help='The number of training steps')
     parser.add_argument('--policy', type=str, default='pg',
                         help='The policy to use')
+    parser.add_argument('--n_envs', type=int, default=0,
+                        help='The number of environments to play in lock-step while training (0 plays them one by one)')
+    parser.add_argument('--episodes_per_update', type=int, default=10,
+                        help='The number of episodes per policy update')
+    parser.add_argument('--batched_update', action='store_true',
+                        help='Record only observations and actions, and compute the policy gradient in one run')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='The number of rollout worker processes (0 plays the episodes in this process)')
+    parser.add_argument('--simulator', type=str, default='gym', choices=['gym', 'numpy'],
+                        help='The CartPole implementation to use')
     parser.add_argument('--render', type=bool, default=True,
-                        help='Set True to render the scene')
+                        help='Set True to render the scene (ignored by --workers and --simulator numpy, which '
+                             'do not evaluate the episodes in a gym environment of this process)')
     FLAGS, unparsed = parser.parse_known_args()
     tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
@@ -0,0 +1,93 @@
+import numpy as np
+
+TERMINATION_REWARD = 200
+TERMINATION_ANGLE = 12.0
+TERMINATION_POSITION = 2.4
+
+# physics of CartPole-v0
+GRAVITY = 9.8
+MASS_CART = 1.0
+MASS_POLE = 0.1
+TOTAL_MASS = MASS_CART + MASS_POLE
+LENGTH = 0.5  # half the length of the pole
+POLE_MASS_LENGTH = MASS_POLE * LENGTH
+FORCE_MAG = 10.0
+TAU = 0.02  # seconds between state updates
+
+
+class BatchedCartPole(object):
+    """
+    NumPy implementation of N CartPole-v0 environments, which are stepped at once with array state.
+
+    The dynamics, the termination rules (pole angle, cart position and a limit of 200 steps) and the rewards
+    match the gym environment. Environments, whose episode is done, are not stepped any more and get a reward
+    of 0, until they are reset.
+    """
+    def __init__(self, n_envs, seed=None, random_state=None):
+        self.n_envs = n_envs
+        self.random_state = np.random.RandomState(seed) if random_state is None else random_state
+        self.state = np.zeros((n_envs, 4))
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+        self.done = np.ones(n_envs, dtype=bool)
+        self.theta_threshold = TERMINATION_ANGLE * 2 * np.pi / 360
+
+    def reset(self, mask=None):
+        """Resets all environments, or those selected by the boolean mask, and returns all observations.
+        """
+        if mask is None:
+            mask = np.ones(self.n_envs, dtype=bool)
+        self.state[mask] = self.random_state.uniform(-0.05, 0.05, size=(np.sum(mask), 4))
+        self.steps[mask] = 0
+        self.done[mask] = False
+        return self.state.copy()
+
+    def step(self, actions):
+        """Applies the actions (0: left, 1: right) to the environments, whose episode is not done.
+        Returns the observations, rewards and done flags of all environments.
+        """
+        active = ~self.done
+        x, x_dot, theta, theta_dot = self.state[active].T
+        force = np.where(np.asarray(actions)[active] == 1, FORCE_MAG, -FORCE_MAG)
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+
+        temp = (force + POLE_MASS_LENGTH * theta_dot ** 2 * sin_theta) / TOTAL_MASS
+        theta_acc = (GRAVITY * sin_theta - cos_theta * temp) / \
+            (LENGTH * (4.0 / 3.0 - MASS_POLE * cos_theta ** 2 / TOTAL_MASS))
+        x_acc = temp - POLE_MASS_LENGTH * theta_acc * cos_theta / TOTAL_MASS
+
+        # explicit euler integration like gym: the positions are updated with the old velocities
+        x = x + TAU * x_dot
+        x_dot = x_dot + TAU * x_acc
+        theta = theta + TAU * theta_dot
+        theta_dot = theta_dot + TAU * theta_acc
+        self.state[active] = np.stack([x, x_dot, theta, theta_dot], axis=1)
+        self.steps[active] += 1
+
+        rewards = active.astype(np.float64)
+        self.done[active] = (np.abs(x) > TERMINATION_POSITION) | (np.abs(theta) > self.theta_threshold) | \
+            (self.steps[active] >= TERMINATION_REWARD)
+        return self.state.copy(), rewards, self.done.copy()
+
+    def __getitem__(self, index):
+        """Returns a batch of as many environments as the slice selects, which shares the random state.
+        Its state is not shared, so it has to be reset before stepping it.
+        """
+        return BatchedCartPole(len(range(*index.indices(self.n_envs))), random_state=self.random_state)
+
+
+class CartPoleEnv(object):
+    """Single CartPole-v0 environment with the reset/step interface of gym, backed by a BatchedCartPole.
+    """
+    def __init__(self, seed=None):
+        self.envs = BatchedCartPole(1, seed)
+
+    def reset(self):
+        return self.envs.reset()[0]
+
+    def step(self, action):
+        obs, rewards, done = self.envs.step([action])
+        return obs[0], rewards[0], done[0], {}
+
+    def render(self):
+        pass
@@ -6,21 +6,158 @@ import gym
 import numpy as np
 import tensorflow as tf
 
-from collections import deque
 
-
-def preprocess_observation(obs):
-    mspacman_color = np.array([210, 164, 74])
+def preprocess_frame(obs):
+    """Crops, downsizes and greyscales the observation to a (88 x 80 x 1) uint8 frame.
+    """
+    mspacman_color = np.array([210, 164, 74]).mean()
     img = obs[1:176:2, ::2]  # crop and downsize
     img = img.mean(axis=2)  # greyscale
     img[img == mspacman_color] = 0  # improve contrast
-    img.reshape(88, 80, 1)
-    img = (img - 128) / 128 - 1  # normalize [-1, 1]
-    return img.reshape(88, 80, 1)
+    return np.round(img).astype(np.uint8).reshape(88, 80, 1)
+
+
+def frames_to_states(frames):
+    return (frames.astype(np.float32) - 128) / 128 - 1  # normalize [-1, 1]
+
+
+def preprocess_observation(obs):
+    return frames_to_states(preprocess_frame(obs))
+
+
+class ReplayMemory(object):
+    """
+    Fixed-capacity ring buffer of transitions in preallocated arrays.
+
+    Each frame is stored once as uint8: the next state of a transition is the frame of the following slot.
+    That frame belongs to the next episode, if the transition ended an episode, but then it is ignored,
+    because its continue flag is 0. The latest transition is not sampled, until its next frame is stored.
+    """
+    def __init__(self, capacity, frame_shape=(88, 80, 1)):
+        self.capacity = capacity
+        self.frames = np.empty((capacity,) + tuple(frame_shape), dtype=np.uint8)
+        self.actions = np.empty(capacity, dtype=np.int32)
+        self.rewards = np.empty(capacity, dtype=np.float32)
+        self.continues = np.empty(capacity, dtype=np.float32)
+        self.index = 0  # slot of the next transition
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, frame, action, reward, cont):
+        self.frames[self.index] = frame
+        self.actions[self.index] = action
+        self.rewards[self.index] = reward
+        self.continues[self.index] = cont
+        self.index = (self.index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size):
+        """Returns the states, actions, rewards, next states and continue flags of random transitions.
+        """
+        oldest = (self.index - self.size) % self.capacity
+        indices = (oldest + np.random.randint(0, self.size - 1, size=batch_size)) % self.capacity
+        return self._gather(indices)
+
+    def _gather(self, indices):
+        next_indices = (indices + 1) % self.capacity
+        return (frames_to_states(self.frames[indices]), self.actions[indices], self.rewards[indices].reshape(-1, 1),
+                frames_to_states(self.frames[next_indices]), self.continues[indices].reshape(-1, 1))
+
+
+class SumTree(object):
+    """
+    Binary tree in a flat array, whose leaves hold the priorities and whose inner nodes hold the sums of
+    their children (the root, at index 1, holds the total). Updates and lookups take O(log N) and are
+    vectorized over batches of indices or values.
+    """
+    def __init__(self, capacity):
+        self.depth = int(np.ceil(np.log2(max(capacity, 2))))
+        self.size = 2 ** self.depth  # number of leaves
+        self.tree = np.zeros(2 * self.size)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def priorities(self, indices):
+        return self.tree[indices + self.size]
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices, dtype=np.int64) + self.size
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            # recompute the parents from their children, so that no rounding errors add up
+            # (parents, which appear several times, get the same sum each time)
+            nodes //= 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the indices of the leaves, where the cumulative sum of the priorities reaches the values.
+        Leaves with a priority of 0 are never returned (unless all are 0).
+        """
+        tree = self.tree
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            # in-place operations, since the batches are small and the overhead per operation dominates
+            nodes *= 2
+            left_sums = tree[nodes]
+            go_right = values >= left_sums
+            go_right &= tree[nodes + 1] > 0
+            values -= left_sums * go_right
+            nodes += go_right
+        return nodes - self.size
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    Replay memory, which samples the transitions with probabilities proportional to their priority
+    (|TD error| + eps) ** alpha, and returns the importance-sampling weights, which correct the bias.
+
+    New transitions get the maximum priority so far. The priority of the latest transition stays 0,
+    until its next frame is stored, so that it is not sampled.
+    """
+    def __init__(self, capacity, frame_shape=(88, 80, 1), alpha=0.6, eps=1e-6):
+        super(PrioritizedReplayMemory, self).__init__(capacity, frame_shape)
+        self.alpha = alpha
+        self.eps = eps
+        self.max_priority = 1.0
+        self.sum_tree = SumTree(capacity)
+
+    def append(self, frame, action, reward, cont):
+        previous = (self.index - 1) % self.capacity
+        has_previous = self.size > 0
+        current = self.index
+        super(PrioritizedReplayMemory, self).append(frame, action, reward, cont)
+        if has_previous:
+            self.sum_tree.update([previous, current], [self.max_priority, 0.0])
+        else:
+            self.sum_tree.update([current], [0.0])
+
+    def sample(self, batch_size, beta=0.4):
+        """Returns the transitions, as `ReplayMemory.sample`, and additionally their indices and
+        their importance-sampling weights (normalized by the largest weight of the batch).
+        """
+        # stratified sampling: one value out of each of batch_size equal segments of the total
+        segment = self.sum_tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        indices = self.sum_tree.find(values)
+
+        probabilities = self.sum_tree.priorities(indices) / self.sum_tree.total
+        weights = ((self.size - 1) * probabilities) ** -beta
+        weights /= weights.max()
+        return self._gather(indices) + (indices, weights.astype(np.float32).reshape(-1, 1))
+
+    def update_priorities(self, indices, td_errors):
+        priorities = (np.abs(np.ravel(td_errors)) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(indices, priorities)
 
 
 class DQN(object):
-    def __init__(self, n_outputs, replay_memory_size):
+    def __init__(self, n_outputs, replay_memory_size, prioritized_replay=False):
         self.input_height = 88
         self.input_width = 80
         self.input_channels = 1
@@ -36,7 +173,10 @@ class DQN(object):
         self.n_outputs = n_outputs  # env.action_space.n
         self.initializer = tf.contrib.layers.variance_scaling_initializer()
 
-        self.replay_memory = deque([], maxlen=replay_memory_size)
+        memory_cls = PrioritizedReplayMemory if prioritized_replay else ReplayMemory
+        self.replay_memory = memory_cls(replay_memory_size, (self.input_height, self.input_width, self.input_channels))
+        self.prioritized_replay = prioritized_replay
+        self.beta_start = 0.4  # importance-sampling exponent, which is annealed to 1
 
         self.eps_min = 0.05
         self.eps_max = 1.0
@@ -46,6 +186,8 @@ class DQN(object):
         self.x_state_ph = None
         self.x_action_ph = None
         self.y_ph = None
+        self.weights_ph = None
+        self.td_errors = None
         self.global_step = None
         self.train_op = None
         self.copy_critic_to_actor = None
@@ -89,21 +231,14 @@ class DQN(object):
         q_value = tf.reduce_sum(critic_q_values * tf.one_hot(self.x_action_ph, self.n_outputs), axis=1, keep_dims=True)
 
         self.y_ph = tf.placeholder(tf.float32, shape=[None, 1])
-        cost = tf.reduce_mean(tf.square(self.y_ph - q_value))
+        # importance-sampling weights of prioritized replay, all 1 for uniform replay
+        self.weights_ph = tf.placeholder_with_default(tf.ones_like(self.y_ph), shape=[None, 1])
+        self.td_errors = self.y_ph - q_value
+        cost = tf.reduce_mean(self.weights_ph * tf.square(self.td_errors))
         self.global_step = tf.train.create_global_step()
         optimizer = tf.train.AdamOptimizer(learning_rate)
         self.train_op = optimizer.minimize(cost, self.global_step)  # gstep missing for auto increment?
 
-    def _sample_memories(self, batch_size):
-        indices = np.random.permutation(len(self.replay_memory))[:batch_size]
-        cols = [[], [], [], [], []]  # state, action, reward, next_state, continue
-        for idx in indices:
-            memory = self.replay_memory[idx]
-            for col, value in zip(cols, memory):
-                col.append(value)
-        cols = [np.array(col) for col in cols]
-        return cols[0], cols[1], cols[2].reshape(-1, 1), cols[3], cols[4].reshape(-1, 1)
-
     def _epsilon_greedy(self, q_values, step):
         epsilon = max(self.eps_min, self.eps_max - (self.eps_max - self.eps_min) * step / self.eps_decay_steps)
         if np.random.rand() < epsilon:
@@ -124,6 +259,7 @@ class DQN(object):
         iteration = 0
         checkpoint_path = './tmp/mspacman_agent.ckpt'
         done = True
+        frame = None
         state = None
 
         self.eps_decay_steps = min(n_iterations * 4, self.eps_decay_steps_max)
@@ -142,7 +278,8 @@ class DQN(object):
                 obs = env.reset()
                 for skip in range(skip_start):
                     obs, reward, done, info = env.step(0)
-                state = preprocess_observation(obs)
+                frame = preprocess_frame(obs)
+                state = frames_to_states(frame)
 
             # actor evaluates what to do
             q_values = self.sess.run(self.actor_q_values, feed_dict={self.x_state_ph: [state]})
@@ -150,11 +287,12 @@ class DQN(object):
 
             # actor plays
             obs, reward, done, info = env.step(action)
-            next_state = preprocess_observation(obs)
+            next_frame = preprocess_frame(obs)
 
-            # let's memorize what just happened
-            self.replay_memory.append((state, action, reward, next_state, 1.0 - done))
-            state = next_state
+            # let's memorize what just happened, the next state is the frame of the following transition
+            self.replay_memory.append(frame, action, reward, 1.0 - done)
+            frame = next_frame
+            state = frames_to_states(frame)
 
             if iteration % 100 == 0:
                 print('Iteration: {}'.format(iteration))
@@ -163,14 +301,23 @@ class DQN(object):
                 continue
 
             # critic learns
-            x_state_val, x_action_val, rewards, x_next_state_val, continues = (
-                self._sample_memories(batch_size))
+            if self.prioritized_replay:
+                beta = min(1.0, self.beta_start + (1.0 - self.beta_start) * gstep / n_iterations)
+                x_state_val, x_action_val, rewards, x_next_state_val, continues, indices, weights = (
+                    self.replay_memory.sample(batch_size, beta))
+            else:
+                x_state_val, x_action_val, rewards, x_next_state_val, continues = (
+                    self.replay_memory.sample(batch_size))
+                weights = np.ones((batch_size, 1), dtype=np.float32)
             next_q_values = self.sess.run(self.actor_q_values, feed_dict={self.x_state_ph: x_next_state_val})
             max_next_q_values = np.max(next_q_values, axis=1, keepdims=True)
             y_val = rewards + continues * discount_rate * max_next_q_values
-            self.sess.run(self.train_op, feed_dict={self.x_state_ph: x_state_val,
-                                                    self.x_action_ph: x_action_val,
-                                                    self.y_ph: y_val})
+            _, td_errors = self.sess.run([self.train_op, self.td_errors], feed_dict={self.x_state_ph: x_state_val,
+                                                                                    self.x_action_ph: x_action_val,
+                                                                                    self.y_ph: y_val,
+                                                                                    self.weights_ph: weights})
+            if self.prioritized_replay:
+                self.replay_memory.update_priorities(indices, td_errors)
 
             if gstep % copy_steps == 0:
                 self.sess.run(self.copy_critic_to_actor)
@@ -190,7 +337,8 @@ def main(_):
     env = gym.make('MsPacman-v0')
 
     dqn = DQN(n_outputs=env.action_space.n,
-              replay_memory_size=10000)
+              replay_memory_size=FLAGS.replay_memory_size,
+              prioritized_replay=FLAGS.prioritized_replay)
     dqn.build(learning_rate=0.001)
     dqn.train(env, FLAGS.train_steps)
 
@@ -230,6 +378,10 @@ if __name__ == '__main__':
                         help='The max number of steps per episode')
     parser.add_argument('--train_steps', type=int, default=1000,
                         help='The number of training steps')
+    parser.add_argument('--replay_memory_size', type=int, default=1000000,
+                        help='The number of transitions in the replay memory (about 7KB each)')
+    parser.add_argument('--prioritized_replay', action='store_true',
+                        help='Sample the transitions by the size of their TD errors, instead of uniformly')
     parser.add_argument('--render', type=bool, default=True,
                         help='Set True to render the scene')
     FLAGS, unparsed = parser.parse_known_args()
@@ -1,9 +1,8 @@
 import numpy as np
 import tensorflow as tf
 
-from sklearn.utils import shuffle
-
 import unsupervised_learning.tensorflow.utils as utils
+from utils.batches import BatchIterator
 
 
 class AutoEncoder(object):
@@ -34,16 +33,14 @@ class AutoEncoder(object):
         self.train_op = tf.train.AdamOptimizer(learning_rate).minimize(self.cost)
 
     def fit(self, X, epochs, batch_size, show_fig=False):
-        num_examples = X.shape[0]
-        n_batches = num_examples // batch_size
+        batches = BatchIterator(X, batch_size)
+        n_batches = len(batches)
 
         costs = []
         print("training autoencoder: %s" % self.id)
         for i in range(epochs):
             print("epoch:", i)
-            X = shuffle(X)
-            for j in range(n_batches):
-                batch = X[j*batch_size:(j*batch_size + batch_size)]
+            for j, batch in enumerate(batches):
                 _, c = self.session.run((self.train_op, self.cost), feed_dict={self.X_in: batch})
                 if j % 10 == 0:
                     print("j / n_batches:", j, "/", n_batches, "cost:", c)
@@ -109,16 +106,14 @@ class RBM(object):
                 logits=logits))
 
     def fit(self, X, epochs, batch_size, show_fig=False):
-        num_examples, input_size = X.shape
-        n_batches = num_examples // batch_size
+        batches = BatchIterator(X, batch_size)
+        n_batches = len(batches)
 
         costs = []
         print("training rbm: %s" % self.id)
         for i in range(epochs):
             print("epoch:", i)
-            X = shuffle(X)
-            for j in range(n_batches):
-                batch = X[j * batch_size:(j * batch_size + batch_size)]
+            for j, batch in enumerate(batches):
                 _, c = self.session.run((self.train_op, self.cost), feed_dict={self.X_in: batch})
                 if j % 10 == 0:
                     print("j / n_batches:", j, "/", n_batches, "cost:", c)
@@ -186,8 +181,6 @@ class DNN(object):
         self.prediction = tf.argmax(logits, 1)
 
     def fit(self, X, Y, Xtest, Ytest, epochs, batch_size, pretrain=False, show_fig=False):
-        num_examples = len(X)
-
         print("greedy layer-wise training of autoencoders...")
         pretrain_epochs = 1
         if not pretrain:
@@ -200,15 +193,13 @@ class DNN(object):
             # create current_input for the next layer
             current_input = ae.transform(current_input)
 
-        n_batches = num_examples // batch_size
+        batches = BatchIterator((X, Y), batch_size)
+        n_batches = len(batches)
         costs = []
         print("supervised training...")
         for i in range(epochs):
             print("epoch:", i)
-            X, Y = shuffle(X, Y)
-            for j in range(n_batches):
-                Xbatch = X[j * batch_size:(j * batch_size + batch_size)]
-                Ybatch = Y[j * batch_size:(j * batch_size + batch_size)]
+            for j, (Xbatch, Ybatch) in enumerate(batches):
                 self.session.run(
                     self.train_op,
                     feed_dict={self.X: Xbatch, self.Y: Ybatch}
@@ -372,13 +363,11 @@ class VariationalAutoencoder(object):
 
     def fit(self, X, epochs, batch_size):
         costs = []
-        n_batches = len(X) // batch_size
-        print('n_batches: {}'.format(n_batches))
+        batches = BatchIterator(X, batch_size)
+        print('n_batches: {}'.format(len(batches)))
         for epoch in range(epochs):
             print('epoch: {}'.format(epoch))
-            np.random.shuffle(X)
-            for b in range(n_batches):
-                batch = X[b*batch_size:(b+1)*batch_size]
+            for b, batch in enumerate(batches):
                 _, cost = self.sess.run([self.train_op, self.cost], feed_dict={
                     self.X: batch
                 })
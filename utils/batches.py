@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class BatchIterator(object):
+    """
+    Iterates over the batches of an array or a tuple of arrays of equal length, in a new random order each epoch.
+
+    Only a permutation of the indices is shuffled, so the arrays are neither copied nor reordered in place.
+    The examples of each batch are gathered into preallocated buffers, which are reused for every batch:
+    a batch is only valid until the next one is requested. Use `reuse_buffers=False`, if the batches are
+    kept around (e.g. prefetched). Like the original training loops, the last incomplete batch is dropped.
+    """
+    def __init__(self, arrays, batch_size, shuffle=True, reuse_buffers=True):
+        # a tuple holds several arrays, anything else (e.g. a list of filenames) is a single array
+        self.single = not isinstance(arrays, tuple)
+        self.arrays = [np.asarray(a) for a in ([arrays] if self.single else arrays)]
+        if any(len(a) != len(self.arrays[0]) for a in self.arrays):
+            raise Exception('All arrays must have the same length!')
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.reuse_buffers = reuse_buffers
+        self.buffers = None
+        if reuse_buffers:
+            self.buffers = [np.empty((batch_size,) + a.shape[1:], dtype=a.dtype) for a in self.arrays]
+
+    def __len__(self):
+        return len(self.arrays[0]) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.arrays[0])
+        indices = np.random.permutation(n) if self.shuffle else np.arange(n)
+        for j in range(len(self)):
+            batch_indices = indices[j * self.batch_size:(j + 1) * self.batch_size]
+            if self.reuse_buffers:
+                batches = [np.take(a, batch_indices, axis=0, out=buffer)
+                           for a, buffer in zip(self.arrays, self.buffers)]
+            else:
+                batches = [np.take(a, batch_indices, axis=0) for a in self.arrays]
+            yield batches[0] if self.single else tuple(batches)